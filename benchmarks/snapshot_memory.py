@@ -0,0 +1,89 @@
+"""
+Measure the memory snapshots hold per tracked file.
+
+Usage::
+
+    python benchmarks/snapshot_memory.py [FILES]
+
+Builds a tree of FILES files (10000 by default) and uses ``tracemalloc``
+to compare the compact snapshot store with a dict of per-file objects
+carrying a full ``os.stat_result``, the way snapshots were kept before
+they were backed by arrays.  Each run keeps two snapshots (before and
+after), so both one snapshot and a pair are measured.
+"""
+
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from scripttest import TestFileEnvironment
+from snapshot_workers import build_tree
+
+
+class ObjectEntry:
+    """A snapshot entry as a plain object, as FoundFile used to be."""
+
+    def __init__(self, base_path, path, st):
+        self.base_path = base_path
+        self.path = path
+        self.full = os.path.join(base_path, path)
+        self.stat = st
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.hash = None
+        self._bytes = None
+
+
+def object_snapshot(base_path):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(base_path):
+        for name in dirnames + filenames:
+            full = os.path.join(dirpath, name)
+            path = os.path.relpath(full, base_path)
+            result[path] = ObjectEntry(base_path, path, os.stat(full))
+    return result
+
+
+def measure(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def main(argv):
+    files = int(argv[0]) if argv else 10000
+    with tempfile.TemporaryDirectory() as tmp:
+        base_path = os.path.join(tmp, "tree")
+        env = TestFileEnvironment(base_path)
+        build_tree(base_path, files)
+        objects, objects_one = measure(lambda: object_snapshot(base_path))
+        del objects
+        _, objects_two = measure(
+            lambda: (object_snapshot(base_path), object_snapshot(base_path))
+        )
+        snapshot, compact_one = measure(env._find_files)
+        del snapshot
+        _, compact_two = measure(lambda: (env._find_files(), env._find_files()))
+        entries = len(env._find_files())
+        print("%d entries, bytes per entry:" % entries)
+        print("%-20s %10s %10s" % ("", "objects", "compact"))
+        for label, before, after in [
+            ("one snapshot", objects_one, compact_one),
+            ("before and after", objects_two, compact_two),
+        ]:
+            print(
+                "%-20s %10.1f %10.1f  (%.1fx)"
+                % (label, before / entries, after / entries, before / after)
+            )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+"""
+Time snapshots of a synthetic tree with different numbers of workers.
+
+Usage::
+
+    python benchmarks/snapshot_workers.py [FILES] [WORKERS ...]
+
+The tree has FILES files (10000 by default) spread over directories of
+100 files each.  It is built once in a temporary directory, then each
+worker count takes a few snapshots and the best time is reported.
+
+On a fast local disk the numbers stay flat, since building the snapshot
+is then bound by the interpreter.  The workers pay off where ``stat``
+and ``scandir`` calls wait on I/O, as on network or overlay filesystems.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from scripttest import TestFileEnvironment
+
+
+def build_tree(base_path, files, per_dir=100):
+    for index in range(files):
+        dirpath = os.path.join(
+            base_path,
+            "d%03d" % (index // (per_dir * per_dir)),
+            "d%03d" % (index // per_dir),
+        )
+        if index % per_dir == 0:
+            os.makedirs(dirpath, exist_ok=True)
+        with open(os.path.join(dirpath, "f%05d.txt" % index), "wb") as f:
+            f.write(b"x" * (index % 512))
+
+
+def main(argv):
+    files = int(argv[0]) if argv else 10000
+    worker_counts = [int(arg) for arg in argv[1:]] or [1, 2, 4, 8, 16]
+    with tempfile.TemporaryDirectory() as tmp:
+        base_path = os.path.join(tmp, "tree")
+        env = TestFileEnvironment(base_path)
+        build_tree(base_path, files)
+        # Let the files age out of the window where they would be hashed
+        time.sleep(2.5)
+        print("%d files" % files)
+        for workers in worker_counts:
+            env.snapshot_workers = workers
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                snapshot = env._find_files()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print("%3d workers: %8.3fs (%d entries)" % (workers, best, len(snapshot)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,20 +6,58 @@ Helpers for testing command-line scripts
 """
 import sys
 import os
+import asyncio
+import atexit
+import builtins
+import contextlib
+import glob
+import functools
+import io
+import itertools
+import json
+import hashlib
+import importlib
 import stat
 import shutil
 import shlex
 import subprocess
 import re
+import time
+import zipfile
 import zlib
+import threading
+import struct
+import tarfile
+import signal
+import math
+import mmap
+import runpy
+import select
+import socket
+import tempfile
+import traceback
+import types
+import warnings
+from array import array
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from types import TracebackType
 from typing import (
     Any,
     Callable,
     Dict,
+    IO,
     Iterable,
+    Iterator,
     List,
+    Mapping,
+    Match,
+    MutableMapping,
+    NoReturn,
     Optional,
+    Pattern,
+    Sequence,
+    Set,
     Tuple,
     Type,
     Union,
@@ -27,6 +65,18 @@ from typing import (
 
 _ExcInfo = Tuple[Type[BaseException], BaseException, TracebackType]
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+# What output and file contents can be searched for, and searched in
+_SearchPattern = Union[bytes, str, Pattern[bytes]]
+_Buffer = Union[bytes, mmap.mmap]
+
 
 if sys.platform == "win32":
 
@@ -68,7 +118,255 @@ def onerror(func: Callable[..., Any], path: str, exc_info: _ExcInfo) -> None:
         raise
 
 
-__all__ = ["TestFileEnvironment"]
+# A file whose timestamps are this close to the moment a snapshot was taken
+# could be rewritten within the same timestamp tick without its stat
+# changing, so its contents get fingerprinted eagerly.  Filesystems that only
+# store whole seconds (FAT, HFS+, ext3) get a wider window.
+_RACY_NS = 100 * 1000 * 1000
+_RACY_COARSE_NS = 2 * 1000 * 1000 * 1000
+
+# How files can be fingerprinted, and the hash function each one uses
+_FINGERPRINTS = {
+    "auto": "crc32",
+    "stat": "crc32",
+    "content": "crc32",
+    "crc32": "crc32",
+    "blake2b": "blake2b",
+    "sampled": "sampled",
+}
+_HASH_ALGORITHMS = ("crc32", "blake2b", "sampled")
+_HASH_CHUNK_SIZE = 1024 * 1024
+# Files hashed with "sampled" that are bigger than the samples together are
+# hashed from their size, first and last block and this many blocks between
+_SAMPLE_BLOCKS = 8
+_SAMPLE_BLOCK_SIZE = 64 * 1024
+
+_HASH_CACHE_FILE = ".scripttest-hash-cache.json"
+
+# How copytree_from_template() may copy files
+_COPY_MODES = ("auto", "copy", "hardlink")
+# ioctl making a file share the storage of another (a reflink), on Linux
+_FICLONE = 0x40049409
+
+_StatIdentity = Tuple[int, int, int, int, int]
+_HashKey = Tuple[int, int, int, int, int, str]
+
+
+def _stat_identity(st: os.stat_result) -> _StatIdentity:
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _check_fingerprint(fingerprint: str) -> None:
+    if fingerprint not in _FINGERPRINTS:
+        raise ValueError(
+            "fingerprint must be one of %s, not %r"
+            % (", ".join(_FINGERPRINTS), fingerprint)
+        )
+
+
+def _hash_file(fp: io.BufferedIOBase, algorithm: str) -> int:
+    """Hash an open file with constant memory."""
+    if algorithm == "sampled":
+        size = os.fstat(fp.fileno()).st_size
+        if size <= (_SAMPLE_BLOCKS + 2) * _SAMPLE_BLOCK_SIZE:
+            algorithm = "blake2b"
+        else:
+            digest = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=8)
+            step = (size - _SAMPLE_BLOCK_SIZE) // (_SAMPLE_BLOCKS + 1)
+            for index in range(_SAMPLE_BLOCKS + 1):
+                fp.seek(index * step)
+                digest.update(fp.read(_SAMPLE_BLOCK_SIZE))
+            fp.seek(size - _SAMPLE_BLOCK_SIZE)
+            digest.update(fp.read(_SAMPLE_BLOCK_SIZE))
+            return int.from_bytes(digest.digest(), "big")
+    buffer = bytearray(_HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    if algorithm == "crc32":
+        value = 0
+        for length in iter(lambda: fp.readinto(buffer), 0):
+            value = zlib.crc32(view[:length], value)
+        return value
+    digest = hashlib.blake2b(digest_size=8)
+    for length in iter(lambda: fp.readinto(buffer), 0):
+        digest.update(view[:length])
+    return int.from_bytes(digest.digest(), "big")
+
+
+class _HashCache:
+    """
+    A bounded LRU mapping from the stat identity of a file and a hash
+    function to the hash of its contents, so unchanged files are not
+    read again.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.modified = False
+        self._entries: "OrderedDict[_HashKey, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: _HashKey) -> Optional[int]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: _HashKey, value: int) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self.modified = True
+
+    def load(self, filename: str) -> None:
+        try:
+            with open(filename) as f:
+                entries = json.load(f)
+            for entry in entries:
+                self.put(tuple(entry[:6]), entry[6])
+        except (OSError, ValueError, TypeError, IndexError):
+            # A missing or damaged cache only costs us some hashing
+            self._entries.clear()
+        self.modified = False
+
+    def save(self, filename: str) -> None:
+        with self._lock:
+            entries = [list(key) + [value] for key, value in self._entries.items()]
+            self.modified = False
+        # A temporary file of its own, as concurrent runs may save at once
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(filename) + ".", dir=os.path.dirname(filename)
+        )
+        try:
+            with open(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, filename)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+
+_CHANGE_TRACKING = ("snapshot", "inotify")
+
+# From <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_LISTING_CHANGED = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_IN_ENTRY_CHANGED = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE
+_IN_WATCH_GONE = _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_IGNORED
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc: Any = None
+
+
+class _Inotify:
+    """
+    Recursive inotify watches on the directories of a snapshot, used to
+    find out which paths a command touched without walking the tree.
+    """
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.dirs: Dict[int, str] = {}
+
+    @classmethod
+    def arm(cls, base_path: str, snapshot: "_Snapshot") -> Optional["_Inotify"]:
+        """
+        Watch ``base_path`` and every directory in ``snapshot``.  Returns
+        None if inotify is unavailable or runs out of watches.
+        """
+        global _libc
+        if not sys.platform.startswith("linux"):
+            return None
+        if _libc is None:
+            try:
+                import ctypes
+
+                _libc = ctypes.CDLL(None, use_errno=True)
+                _libc.inotify_init1
+            except (OSError, AttributeError):
+                _libc = False
+        if not _libc:
+            return None
+        fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        self = cls(fd)
+        mask = _IN_LISTING_CHANGED | _IN_ENTRY_CHANGED | _IN_WATCH_GONE | _IN_ONLYDIR
+        for path in snapshot.children:
+            full = os.path.join(base_path, path) if path else base_path
+            wd = _libc.inotify_add_watch(fd, os.fsencode(full), mask)
+            if wd < 0:
+                self.close()
+                return None
+            self.dirs[wd] = path
+        return self
+
+    def changes(self) -> Optional[Tuple[Set[str], Set[str], Set[str]]]:
+        """
+        Read the queued events.  Returns the directories whose listing
+        changed, the paths whose metadata or contents changed and the
+        watched directories that were removed or moved away, or None if
+        events were lost.
+        """
+        listings: Set[str] = set()
+        entries: Set[str] = set()
+        gone: Set[str] = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+                dirpath = self.dirs.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & _IN_WATCH_GONE:
+                    # Whatever is at this path now was never watched
+                    gone.add(dirpath)
+                    if dirpath:
+                        listings.add(os.path.dirname(dirpath))
+                    continue
+                if not name:
+                    entries.add(dirpath)
+                    continue
+                if mask & _IN_LISTING_CHANGED:
+                    listings.add(dirpath)
+                    entries.add(dirpath)
+                if mask & _IN_ENTRY_CHANGED:
+                    entries.add(os.path.join(dirpath, name) if dirpath else name)
+        return listings, entries, gone
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+__all__ = ["TestFileEnvironment", "EnvironmentPool"]
 
 
 class TestFileEnvironment:
@@ -87,12 +385,32 @@ class TestFileEnvironment:
         environ: Optional[Dict[str, str]] = None,
         cwd: Optional[str] = None,
         start_clear: bool = True,
-        ignore_paths: Optional[Iterable[str]] = None,
+        ignore_paths: Optional[Iterable[Union[str, Pattern[str]]]] = None,
         ignore_hidden: bool = True,
         ignore_temp_paths: Optional[Iterable[str]] = None,
         capture_temp: bool = False,
         assert_no_temp: bool = False,
         split_cmd: bool = True,
+        fingerprint: str = "auto",
+        fingerprint_paths: Optional[Mapping[Union[str, Pattern[str]], str]] = None,
+        hash_cache_size: int = 100000,
+        persist_hash_cache: bool = False,
+        chain_snapshots: bool = False,
+        snapshot_workers: int = 1,
+        watch_paths: Optional[Iterable[str]] = None,
+        change_tracking: str = "snapshot",
+        keep_snapshots: bool = True,
+        output_spill_size: Optional[int] = 16 * 1024 * 1024,
+        report_metrics: bool = False,
+        max_wall: Optional[float] = None,
+        max_cpu: Optional[float] = None,
+        max_rss: Optional[int] = None,
+        enforce_limits: bool = False,
+        timeout: Optional[float] = None,
+        timeout_grace: float = 5.0,
+        forkserver: bool = False,
+        forkserver_preload: Iterable[str] = (),
+        background_clear: bool = False,
     ) -> None:
         """
         Creates an environment.  ``base_path`` is used as the current
@@ -114,14 +432,136 @@ class TestFileEnvironment:
         created.  You can also use ``.clear()`` to clear the files.
 
         ``ignore_paths`` is a set of specific filenames that should be
-        ignored when created in the environment.  ``ignore_hidden``
+        ignored when created in the environment.  Entries may also be
+        wildcards, where ``*`` matches within a path segment and ``**``
+        across segments (a wildcard without a ``/`` is matched against
+        the filename only, at any depth), or compiled regular
+        expressions that must match the whole ``/``-separated path.  A
+        trailing ``/`` restricts an entry to directories, e.g.
+        ``["node_modules/", ".venv/", "build/"]``.  Ignored directories
+        are not descended into.  ``ignore_hidden``
         means, if true (default) that filenames and directories
         starting with ``'.'`` will be ignored.
 
         ``capture_temp`` will put temporary files inside the
         environment (using ``$TMPDIR``).  You can then assert that no
         temporary files are left using ``.assert_no_temp()``.
+
+        ``fingerprint`` controls how files are compared between
+        snapshots.  With ``"auto"`` (default) only ``os.stat`` data is
+        recorded, and file contents are hashed only for files touched
+        right before the snapshot, where a rewrite could go unnoticed by
+        ``stat``.  ``"stat"`` never reads file contents.  ``"crc32"``
+        (or ``"content"``) and ``"blake2b"`` hash every file on every
+        snapshot, and ``"sampled"`` hashes only the size and some blocks
+        of big files, trading precision for speed.  ``fingerprint_paths``
+        maps paths (or wildcards and regular expressions, as in
+        ``ignore_paths``) to the fingerprint to use for them instead; the
+        first match wins.  Runs can override ``fingerprint`` with
+        ``fingerprint``.
+
+        Content hashes are cached by the stat identity of the file
+        (device, inode, size and timestamps), so a file is only hashed
+        again once it changes.  ``hash_cache_size`` bounds the number of
+        cached hashes.  If ``persist_hash_cache`` is true the cache is
+        also saved in ``base_path`` after every run, and reused by
+        later environments on the same directory.
+
+        If ``chain_snapshots`` is true, the snapshot taken after a run is
+        reused as the starting point of the next run, as long as no
+        directory modification time changed in between.  Only use this
+        if the files are changed only through ``.run()``,
+        ``.writefile()`` and ``.clear()``; changes made to the contents of
+        existing files by other means would go unnoticed.
+
+        ``snapshot_workers`` is the number of threads used to list,
+        stat and hash files when taking a snapshot.  More than one
+        helps on filesystems where those calls are slow, such as
+        network or overlay filesystems.
+
+        ``watch_paths`` restricts change tracking to the given files and
+        directories, relative to ``base_path``; by default all of
+        ``base_path`` is watched.  Runs can override it with ``watch``.
+
+        ``change_tracking`` selects how changes made by a run are found.
+        ``"snapshot"`` (default) walks the tree before and after the
+        run.  ``"inotify"`` (Linux only) watches the directories while
+        the command runs and only looks again at what it touched; it
+        falls back to walking the tree when inotify is unavailable or
+        loses events, and for runs that only watch some paths.
+
+        The files of a ``ProcResult`` are compared, and its output
+        decoded, only when first used.  With ``keep_snapshots`` false
+        the before and after snapshots are dropped once compared, which
+        saves memory when many results are kept around.
+
+        Output is read from the command as it is produced.  Once a stream
+        grows past ``output_spill_size`` bytes it is moved to a temporary
+        file; ``None`` keeps all output in memory.
+
+        If ``report_metrics`` is true, the resources used by a command
+        and the time scripttest spent around it are shown when a
+        ``ProcResult`` is printed.
+
+        ``max_wall`` and ``max_cpu`` (in seconds) and ``max_rss`` (in
+        bytes) are the default budgets of runs; see ``.run()``.  With
+        ``enforce_limits`` the CPU and memory budgets are also set as
+        resource limits of the command.
+
+        ``timeout`` and ``timeout_grace`` are the defaults for the
+        keywords of the same name of ``.run()``.
+
+        With ``forkserver`` (POSIX only) runs of ``sys.executable`` with
+        ``-c``, ``-m`` or a script are not started from scratch: a Python
+        process is kept waiting with the modules in
+        ``forkserver_preload`` imported, and forks a child for each run.
+        This saves the interpreter startup and the imports on every run;
+        the result is the same as for a new process, except that the
+        hash seed and the preloaded modules are shared.  Other runs, and
+        runs with ``PYTHON*`` variables different from the environment
+        the server was started with, start a new process as usual.  The
+        server is shared by every environment with the same
+        ``forkserver_preload`` and ``PYTHON*`` variables, and stopped when
+        the interpreter exits.
+
+        With ``background_clear``, ``.clear()`` (including the one done
+        by ``start_clear``) only renames the old directory next to
+        ``base_path`` and deletes it on a background thread, so it takes
+        the same time however many files are left; what is not deleted
+        yet when the interpreter exits is deleted then.
         """
+        if change_tracking not in _CHANGE_TRACKING:
+            raise ValueError(
+                "change_tracking must be one of %s, not %r"
+                % (", ".join(_CHANGE_TRACKING), change_tracking)
+            )
+        self.change_tracking = change_tracking
+        self.keep_snapshots = keep_snapshots
+        self.output_spill_size = output_spill_size
+        self.report_metrics = report_metrics
+        self.max_wall = max_wall
+        self.max_cpu = max_cpu
+        self.max_rss = max_rss
+        self.enforce_limits = enforce_limits
+        self.timeout = timeout
+        self.timeout_grace = timeout_grace
+        self.background_clear = background_clear
+        self.forkserver = forkserver
+        self.forkserver_preload = list(forkserver_preload)
+        _check_fingerprint(fingerprint)
+        self.fingerprint = fingerprint
+        self.fingerprint_paths = dict(fingerprint_paths or {})
+        for value in self.fingerprint_paths.values():
+            _check_fingerprint(value)
+        self.hash_cache = _HashCache(hash_cache_size)
+        self.chain_snapshots = chain_snapshots
+        self.snapshot_workers = snapshot_workers
+        self.watch_paths = list(watch_paths) if watch_paths is not None else None
+        self._last_snapshot: Optional[_Snapshot] = None
+        self._last_watch: Optional[Tuple[str, ...]] = None
+        self._last_dir_mtimes: Dict[str, int] = {}
+        # Held while the three above change, as runs may finish at once
+        self._chain_lock = threading.Lock()
         if base_path is None:
             base_path = self._guess_base_path(1)
         self.base_path = base_path
@@ -143,10 +583,16 @@ class TestFileEnvironment:
             self.clear()
         elif not os.path.exists(base_path):
             os.makedirs(base_path)
-        self.ignore_paths = ignore_paths or []
+        self.ignore_paths = list(ignore_paths or [])
+        self._ignore_rules: Optional[Tuple[Any, ...]] = None
+        self._fingerprint_rules: Optional[Tuple[Any, ...]] = None
+        self._fingerprint_matchers: List[Tuple[Pattern[str], str]] = []
         self.ignore_temp_paths = ignore_temp_paths or []
         self.ignore_hidden = ignore_hidden
         self.split_cmd = split_cmd
+        self.persist_hash_cache = persist_hash_cache
+        if persist_hash_cache:
+            self.hash_cache.load(os.path.join(base_path, _HASH_CACHE_FILE))
 
         if assert_no_temp and not self.capture_temp:
             raise TypeError("You cannot use assert_no_temp unless capture_temp=True")
@@ -177,30 +623,438 @@ class TestFileEnvironment:
             Don't raise an exception in case of errors
         ``expect_stderr``: (default ``expect_error``)
             Don't raise an exception if anything is printed to stderr
-        ``stdin``: (default ``""``)
-            Input to the script
+        ``stdin``: (default ``b""``)
+            Input to the script, as bytes
         ``cwd``: (default ``self.cwd``)
             The working directory to run in (default ``base_path``)
         ``quiet``: (default False)
             When there's an error (return code != 0), do not print
             stdout/stderr
+        ``watch``: (default ``self.watch_paths``)
+            Only look for changes to these paths (relative to
+            ``base_path``)
+        ``snapshot``: (default True)
+            If false, don't look for changed files at all; the
+            ``files_*`` attributes of the result will be empty
+        ``fingerprint``: (default ``self.fingerprint``)
+            How to compare the files this run touched; see
+            ``fingerprint`` in ``__init__``
+        ``max_wall``, ``max_cpu``: (default ``self.max_wall``, ``self.max_cpu``)
+            Raise an exception if the command took longer than this many
+            seconds of wall clock or CPU (user plus system) time
+        ``max_rss``: (default ``self.max_rss``)
+            Raise an exception if the peak resident memory of the
+            command was more than this many bytes
+        ``enforce_limits``: (default ``self.enforce_limits``)
+            Also make ``max_cpu`` and ``max_rss`` resource limits of the
+            command (with ``setrlimit``, where available), so it is
+            killed when it goes over.  The memory limit applies to the
+            address space, which is larger than the resident memory.
+        ``timeout``: (default ``self.timeout``)
+            Stop the command after this many seconds.  It is started in
+            a session of its own, and its whole process group gets a
+            SIGTERM, then a SIGKILL ``timeout_grace`` seconds (default
+            ``self.timeout_grace``) later.  The result has the output
+            and files up to that point, and ``timed_out`` set; unless
+            ``expect_error`` is true an exception is raised.
 
         Returns a `ProcResult
         <class-paste.fixture.ProcResult.html>`_ object.
         """
         __tracebackhide__ = True
-        expect_error = kw.pop("expect_error", False)
-        expect_stderr = kw.pop("expect_stderr", expect_error)
-        cwd = kw.pop("cwd", self.cwd)
-        stdin = kw.pop("stdin", None)
-        quiet = kw.pop("quiet", False)
-        debug = kw.pop("debug", False)
+        return self._execute(self._prepare_run(script, args, kw))
+
+    def run_python(self, target: str, *args: Any, **kw: Any) -> "ProcResult":
+        """
+        Run a Python program in this process instead of starting a new
+        one, and return a ``ProcResult`` like ``.run()`` does.
+        ``target`` is the name of an installed console script, an entry
+        point like ``"package.cli:main"``, or a module to run like
+        ``python -m``.  The other arguments and keywords are those of
+        ``.run()``.
+
+        ``sys.argv``, the working directory, ``os.environ`` and the
+        standard streams are switched for the call, and ``SystemExit`` or
+        an uncaught exception sets the return code.  As this changes the
+        state of the whole process, only one such call runs at a time.
+        Output written directly to the file descriptors (by subprocesses
+        or extensions) is not captured, and ``timeout`` and
+        ``enforce_limits`` have no effect.
+
+        With ``isolate=True`` (POSIX only) the program is run in a forked
+        child instead, so whatever it changes in the interpreter is
+        thrown away, and all the options of ``.run()`` apply.
+        """
+        __tracebackhide__ = True
+        isolate = kw.pop("isolate", False)
+        inv = self._prepare_run(target, args, kw)
+        inv.in_process = "isolate" if isolate else "inline"
+        return self._execute(inv)
+
+    def _run_inline(
+        self, inv: "_Invocation"
+    ) -> Tuple["CapturedOutput", "CapturedOutput", int]:
+        """Run the ``.run_python()`` target of ``inv`` in this process."""
+        stdout = CapturedOutput(self.output_spill_size)
+        stderr = CapturedOutput(self.output_spill_size)
+        writers = [_OutputWriter(stdout), _OutputWriter(stderr)]
+        with _inline_lock:
+            saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr)
+            saved_cwd = os.getcwd()
+            saved_environ = dict(os.environ)
+            try:
+                if inv.cwd:
+                    os.chdir(inv.cwd)
+                os.environ.clear()
+                os.environ.update(clean_environ(self.environ))
+                sys.stdin = io.TextIOWrapper(io.BytesIO(inv.stdin or b""), "utf-8")
+                sys.stdout = io.TextIOWrapper(io.BufferedWriter(writers[0]), "utf-8")
+                sys.stderr = io.TextIOWrapper(
+                    io.BufferedWriter(writers[1]),
+                    "utf-8",
+                    "backslashreplace",
+                    line_buffering=True,
+                )
+                returncode = _run_python_target(inv.args[0], inv.args[1:])
+                for stream in (sys.stdout, sys.stderr):
+                    if not stream.closed:
+                        stream.flush()
+            finally:
+                sys.argv, sys.stdin, sys.stdout, sys.stderr = saved
+                os.chdir(saved_cwd)
+                os.environ.clear()
+                os.environ.update(saved_environ)
+                for writer in writers:
+                    writer.output = None
+                stdout.close()
+                stderr.close()
+        return stdout, stderr, returncode
+
+    def _execute(self, inv: "_Invocation") -> "ProcResult":
+        __tracebackhide__ = True
+        files_before, inotify = self._start_tracking(inv)
+        try:
+            started = time.perf_counter()
+            server = self._get_forkserver(inv)
+            proc: Any = None
+            if inv.in_process == "isolate":
+                target = inv.args[0]
+                proc = _fork_child(
+                    inv.args,
+                    inv.cwd or os.getcwd(),
+                    clean_environ(self.environ),
+                    inv.limits(),
+                    lambda: _run_python_target(target, inv.args[1:]),
+                )
+            elif inv.in_process:
+                pass  # see below
+            elif server is not None:
+                proc = server.spawn(
+                    inv.args[1:],
+                    inv.cwd or os.getcwd(),
+                    clean_environ(self.environ),
+                    inv.limits(),
+                )
+            elif inv.debug:
+                proc = subprocess.Popen(
+                    inv.args,
+                    cwd=inv.cwd,
+                    # see http://bugs.python.org/issue8557
+                    shell=(sys.platform == "win32"),
+                    env=clean_environ(self.environ),
+                    preexec_fn=inv.preexec_fn(),
+                    start_new_session=inv.timeout is not None,
+                )
+            else:
+                proc = subprocess.Popen(
+                    inv.args,
+                    stdin=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    cwd=inv.cwd,
+                    # see http://bugs.python.org/issue8557
+                    shell=(sys.platform == "win32"),
+                    env=clean_environ(self.environ),
+                    preexec_fn=inv.preexec_fn(),
+                    start_new_session=inv.timeout is not None,
+                )
+
+            inv.timings["spawn"] = time.perf_counter() - started
+            if proc is None:
+                stdout, stderr, returncode = self._run_inline(inv)
+                rusage = None
+            elif inv.debug:
+                deadline = None
+                if inv.timeout is not None:
+                    deadline = time.monotonic() + inv.timeout
+                rusage, inv.timed_out = _wait_or_stop(proc, deadline, inv.timeout_grace)
+                stdout, stderr = CapturedOutput(), CapturedOutput()
+                stdout.close()
+                stderr.close()
+            else:
+                stdout, stderr, rusage, inv.timed_out = _capture(
+                    proc,
+                    inv.stdin,
+                    self.output_spill_size,
+                    inv.timeout,
+                    inv.timeout_grace,
+                )
+            if proc is not None:
+                returncode = proc.returncode
+            inv.timings["communicate"] = (
+                time.perf_counter() - started - inv.timings["spawn"]
+            )
+            inv.metrics["wall"] = time.perf_counter() - started
+            inv.metrics.update(_rusage_metrics(rusage))
+        except BaseException:
+            if inotify is not None:
+                inotify.close()
+            raise
+        return self._finish_run(inv, files_before, inotify, stdout, stderr, returncode)
+
+    def _get_forkserver(self, inv: "_Invocation") -> Optional["_ForkServer"]:
+        """
+        The fork server to run ``inv`` with, started if needed, or None
+        if it must be run as a new process.
+        """
+        if not self.forkserver or inv.debug or inv.in_process:
+            return None
+        if not hasattr(os, "fork"):
+            return None
+        if not _forkable_python(inv.args):
+            return None
+        key = (
+            tuple(self.forkserver_preload),
+            tuple(sorted(_python_environ(self.environ).items())),
+        )
+        with _forkservers_lock:
+            server = _forkservers.get(key)
+            if server is not None and server.proc.poll() is not None:
+                server.close()
+                server = None
+            if server is None:
+                try:
+                    server = _ForkServer(
+                        self.forkserver_preload,
+                        clean_environ(self.environ),
+                        self.base_path,
+                    )
+                except OSError:
+                    # e.g. a preloaded module failed to import
+                    self.forkserver = False
+                    return None
+                _forkservers[key] = server
+        return server
+
+    async def arun(self, script: str, *args: Any, **kw: Any) -> "ProcResult":
+        """
+        Like ``.run()``, but a coroutine: the command is run with
+        ``asyncio``, and the snapshots are taken on the event loop's
+        default executor, so several commands can run at once.  Use
+        ``watch`` (or ``.agather()``) to keep concurrent commands from
+        seeing each other's changes.
+        """
+        __tracebackhide__ = True
+        inv = self._prepare_run(script, args, kw)
+        if inv.debug:
+            raise TypeError("debug is not supported by arun()")
+        loop = asyncio.get_running_loop()
+        files_before, inotify = await loop.run_in_executor(
+            None, self._start_tracking, inv
+        )
+        try:
+            started = time.perf_counter()
+            if sys.platform == "win32":
+                proc = await asyncio.create_subprocess_shell(
+                    subprocess.list2cmdline(inv.args),
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    cwd=inv.cwd,
+                    env=clean_environ(self.environ),
+                )
+            else:
+                proc = await asyncio.create_subprocess_exec(
+                    *inv.args,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    cwd=inv.cwd,
+                    env=clean_environ(self.environ),
+                    preexec_fn=inv.preexec_fn(),
+                    start_new_session=inv.timeout is not None,
+                )
+            inv.timings["spawn"] = time.perf_counter() - started
+            stdout = CapturedOutput(self.output_spill_size)
+            stderr = CapturedOutput(self.output_spill_size)
+            capture = asyncio.ensure_future(_acapture(proc, inv.stdin, stdout, stderr))
+            inv.timed_out = await _astop_on_timeout(
+                proc, inv.timeout, inv.timeout_grace
+            )
+            returncode = await proc.wait()
+            try:
+                await asyncio.wait_for(
+                    capture, inv.timeout_grace if inv.timed_out else None
+                )
+            except asyncio.TimeoutError:
+                # Something the command started still holds the pipes open
+                _signal_group(proc, kill=True)
+                stdout.close()
+                stderr.close()
+            inv.timings["communicate"] = (
+                time.perf_counter() - started - inv.timings["spawn"]
+            )
+            # The event loop reaps the process, so only wall time is known
+            inv.metrics["wall"] = time.perf_counter() - started
+        except BaseException:
+            if inotify is not None:
+                inotify.close()
+            raise
+        return await loop.run_in_executor(
+            None,
+            self._finish_run,
+            inv,
+            files_before,
+            inotify,
+            stdout,
+            stderr,
+            returncode,
+        )
+
+    async def agather(
+        self,
+        *jobs: Union[str, Sequence[Any], Mapping[str, Any]],
+        sandbox: str = "job-%d",
+    ) -> List["ProcResult"]:
+        """
+        Run several commands at once with ``.arun()``, each in its own
+        directory under ``base_path`` and only watching that directory.
+        ``sandbox`` names the directories, from the position of the job.
+
+        A job is a command line string, a sequence of the script and its
+        arguments, or a mapping with the command under ``"args"`` and
+        keyword arguments for ``.arun()``.  Returns the results in the
+        order of the jobs.
+        """
+        __tracebackhide__ = True
+        calls = self._sandbox_jobs(jobs, sandbox)
+        return list(
+            await asyncio.gather(
+                *(self.arun(script, *args, **kw) for script, args, kw in calls)
+            )
+        )
+
+    def run_many(
+        self,
+        jobs: Iterable[Union[str, Sequence[Any], Mapping[str, Any]]],
+        max_workers: Optional[int] = None,
+        sandbox: str = "job-%d",
+    ) -> List["ProcResult"]:
+        """
+        Run several commands at once on a pool of ``max_workers``
+        threads, each in its own directory under ``base_path`` and only
+        watching that directory, as with ``.agather()``.  Jobs are given
+        the same way too.
+
+        Returns the results in the order of the jobs.  The
+        ``expect_error`` and ``expect_stderr`` checks, and the budgets,
+        are checked once all jobs are done, and reported together in a
+        single ``AssertionError``.
+        """
+        __tracebackhide__ = True
+        invocations = []
+        for script, args, kw in self._sandbox_jobs(jobs, sandbox):
+            inv = self._prepare_run(script, args, kw)
+            inv.check = False
+            invocations.append(inv)
+        with ThreadPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(self._execute, inv) for inv in invocations]
+            results = [future.result() for future in futures]
+        failures = []
+        for index, (inv, result) in enumerate(zip(invocations, results)):
+            try:
+                result.assert_within_budget(inv.budget, inv.quiet, inv.enforce_limits)
+                if not inv.expect_error:
+                    result.assert_no_error(inv.quiet)
+                if not inv.expect_stderr:
+                    result.assert_no_stderr(inv.quiet)
+            except AssertionError as e:
+                failures.append("job %d (%s): %s" % (index, " ".join(result.args), e))
+        if failures:
+            raise AssertionError(
+                "%s of %s jobs failed:\n%s"
+                % (len(failures), len(results), "\n".join(failures))
+            )
+        # The temporary directory is shared, so it is checked once
+        if any(not inv.expect_temp for inv in invocations):
+            self.assert_no_temp()
+        return results
+
+    def _sandbox_jobs(
+        self, jobs: Iterable[Union[str, Sequence[Any], Mapping[str, Any]]], sandbox: str
+    ) -> List[Tuple[str, List[Any], Dict[str, Any]]]:
+        """
+        Turn jobs into ``(script, args, kw)`` calls that run in (and
+        only watch) a directory of their own.
+        """
+        calls = []
+        for index, job in enumerate(jobs):
+            if isinstance(job, str):
+                command: Union[str, Sequence[Any]] = job
+                kw: Dict[str, Any] = {}
+            elif isinstance(job, Mapping):
+                kw = dict(job)
+                command = kw.pop("args")
+            else:
+                command = job
+                kw = {}
+            if isinstance(command, str):
+                script, args = command, []
+            else:
+                script, args = command[0], list(command[1:])
+            name = sandbox % index
+            os.makedirs(os.path.join(self.base_path, name), exist_ok=True)
+            kw.setdefault("cwd", os.path.join(self.base_path, name))
+            kw.setdefault("watch", [name])
+            calls.append((script, args, kw))
+        return calls
+
+    def _prepare_run(
+        self, script: str, args: Sequence[Any], kw: Dict[str, Any]
+    ) -> "_Invocation":
+        """Check the arguments of a run."""
+        inv = _Invocation()
+        inv.check = True
+        inv.timings = {}
+        inv.metrics = {}
+        inv.expect_error = kw.pop("expect_error", False)
+        inv.expect_stderr = kw.pop("expect_stderr", inv.expect_error)
+        inv.cwd = kw.pop("cwd", self.cwd)
+        inv.stdin = kw.pop("stdin", None)
+        if inv.stdin is not None and not isinstance(inv.stdin, (bytes, bytearray)):
+            raise TypeError("stdin must be bytes, not %s" % type(inv.stdin).__name__)
+        inv.quiet = kw.pop("quiet", False)
+        inv.debug = kw.pop("debug", False)
         if not self.temp_path:
             if "expect_temp" in kw:
                 raise TypeError(
                     "You cannot use expect_temp unless you use " "capture_temp=True"
                 )
-        expect_temp = kw.pop("expect_temp", not self._assert_no_temp)
+        inv.expect_temp = kw.pop("expect_temp", not self._assert_no_temp)
+        inv.watch = _watch_roots(kw.pop("watch", self.watch_paths))
+        inv.snapshot = kw.pop("snapshot", True)
+        inv.fingerprint = kw.pop("fingerprint", self.fingerprint)
+        _check_fingerprint(inv.fingerprint)
+        inv.budget = {
+            "wall": kw.pop("max_wall", self.max_wall),
+            "cpu": kw.pop("max_cpu", self.max_cpu),
+            "rss": kw.pop("max_rss", self.max_rss),
+        }
+        inv.enforce_limits = kw.pop("enforce_limits", self.enforce_limits)
+        inv.timeout = kw.pop("timeout", self.timeout)
+        inv.timeout_grace = kw.pop("timeout_grace", self.timeout_grace)
+        inv.timed_out = False
+        inv.in_process = None
         script_args = list(map(str, args))
         assert not kw, "Arguments not expected: %s" % ", ".join(kw.keys())
         if self.split_cmd and " " in script:
@@ -211,94 +1065,396 @@ class TestFileEnvironment:
                 script, script_args_s = script.split(None, 1)
                 script_args = shlex.split(script_args_s)
 
-        all = [script] + script_args
-
-        files_before = self._find_files()
-
-        if debug:
-            proc = subprocess.Popen(
-                all,
-                cwd=cwd,
-                # see http://bugs.python.org/issue8557
-                shell=(sys.platform == "win32"),
-                env=clean_environ(self.environ),
-            )
-        else:
-            proc = subprocess.Popen(
-                all,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                cwd=cwd,
-                # see http://bugs.python.org/issue8557
-                shell=(sys.platform == "win32"),
-                env=clean_environ(self.environ),
-            )
+        inv.args = [script] + script_args
+        return inv
 
-        if debug:
-            stdout_bytes, stderr_bytes = proc.communicate()
-        else:
-            stdout_bytes, stderr_bytes = proc.communicate(stdin)
-        stdout = string(stdout_bytes)
-        stderr = string(stderr_bytes)
+    def _start_tracking(
+        self, inv: "_Invocation"
+    ) -> Tuple["_Snapshot", Optional[_Inotify]]:
+        """Take the snapshot before a run, and start watching for changes."""
+        if not inv.snapshot:
+            return _Snapshot(), None
+        started = time.perf_counter()
+        files_before = self._snapshot_before(inv.watch, inv.fingerprint)
+        inv.timings["snapshot_before"] = time.perf_counter() - started
+        inotify = None
+        if inv.watch is None and self.change_tracking == "inotify":
+            inotify = _Inotify.arm(self.base_path, files_before)
+        return files_before, inotify
 
-        stdout = string(stdout).replace("\r\n", "\n")
-        stderr = string(stderr).replace("\r\n", "\n")
-        files_after = self._find_files()
+    def _finish_run(
+        self,
+        inv: "_Invocation",
+        files_before: "_Snapshot",
+        inotify: Optional[_Inotify],
+        stdout: "CapturedOutput",
+        stderr: "CapturedOutput",
+        returncode: int,
+    ) -> "ProcResult":
+        """Find what a run changed, and check the result."""
+        __tracebackhide__ = True
+        started = time.perf_counter()
+        try:
+            if not inv.snapshot:
+                # Nobody knows what the command changed
+                self._invalidate_snapshot()
+                files_after = _Snapshot()
+            elif self.chain_snapshots:
+                # Recorded before walking, so changes made meanwhile are caught
+                dir_mtimes = self._top_dir_mtimes()
+                files_after = self._snapshot_after(
+                    files_before, inv.watch, inotify, inv.fingerprint
+                )
+                self._remember_snapshot(files_after, dir_mtimes, inv.watch)
+            else:
+                files_after = self._snapshot_after(
+                    files_before, inv.watch, inotify, inv.fingerprint
+                )
+        finally:
+            if inotify is not None:
+                inotify.close()
+        # Files are compared lazily, so settle the racy ones now
+        files_after.settle(files_before)
+        if self.persist_hash_cache and self.hash_cache.modified:
+            self.hash_cache.save(os.path.join(self.base_path, _HASH_CACHE_FILE))
+        if inv.snapshot:
+            inv.timings["snapshot_after"] = time.perf_counter() - started
         result = ProcResult(
             self,
-            all,
-            stdin,
+            inv.args,
+            inv.stdin,
             stdout,
             stderr,
-            returncode=proc.returncode,
+            returncode=returncode,
             files_before=files_before,
             files_after=files_after,
+            keep_snapshots=self.keep_snapshots,
+            metrics=inv.metrics,
+            timings=inv.timings,
+            timed_out=inv.timed_out,
         )
-        if not expect_error:
-            result.assert_no_error(quiet)
-        if not expect_stderr:
-            result.assert_no_stderr(quiet)
-        if not expect_temp:
-            self.assert_no_temp()
+        if inv.check:
+            result.assert_within_budget(inv.budget, inv.quiet, inv.enforce_limits)
+            if not inv.expect_error:
+                result.assert_no_error(inv.quiet)
+            if not inv.expect_stderr:
+                result.assert_no_stderr(inv.quiet)
+            if not inv.expect_temp:
+                self.assert_no_temp()
         return result
 
-    def _find_files(self) -> Dict[str, Union["FoundDir", "FoundFile"]]:
-        result: Dict[str, Union["FoundDir", "FoundFile"]] = {}
-        for fn in os.listdir(self.base_path):
-            if self._ignore_file(fn):
+    def _snapshot_before(
+        self, watch: Optional[Tuple[str, ...]], fingerprint: str
+    ) -> "_Snapshot":
+        """
+        The snapshot to compare a run against: the one taken after the
+        previous run when it can be reused, otherwise a fresh one.
+        """
+        with self._chain_lock:
+            last = self._last_snapshot
+            last_watch = self._last_watch
+            dir_mtimes = self._last_dir_mtimes
+        if last is not None and last_watch == watch:
+            for path, mtime_ns in dir_mtimes.items():
+                try:
+                    if os.stat(path).st_mtime_ns != mtime_ns:
+                        break
+                except OSError:
+                    break
+            else:
+                return last
+            with self._chain_lock:
+                if self._last_snapshot is last:
+                    self._last_snapshot = None
+                    self._last_dir_mtimes = {}
+        return self._find_files(watch, fingerprint)
+
+    def _snapshot_after(
+        self,
+        files_before: "_Snapshot",
+        watch: Optional[Tuple[str, ...]],
+        inotify: Optional[_Inotify],
+        fingerprint: str,
+    ) -> "_Snapshot":
+        if inotify is not None:
+            changes = inotify.changes()
+            if changes is not None:
+                return self._patch_snapshot(files_before, *changes, fingerprint)
+        return self._find_files(watch, fingerprint)
+
+    def _patch_snapshot(
+        self,
+        files_before: "_Snapshot",
+        listings: Set[str],
+        entries: Set[str],
+        gone: Set[str],
+        fingerprint: str,
+    ) -> "_Snapshot":
+        """
+        Build a new snapshot from ``files_before``, looking again only at
+        the directories whose ``listings`` changed and the changed
+        ``entries``.  Directories that are ``gone`` or came back with
+        another inode are scanned again in full.
+        """
+        result = files_before.copy()
+        snapshot_ns = time.time_ns()
+        new_dirs: List[Tuple[str, str]] = []
+        rescan: Set[str] = set()
+        for dirpath in sorted(listings, key=_path_depth):
+            if dirpath not in result.children or dirpath in rescan:
+                continue  # removed along with a parent, or rescanned below
+            full = os.path.join(self.base_path, dirpath) if dirpath else self.base_path
+            try:
+                _, children, found, subdirs = self._scan_dir(
+                    dirpath, full, snapshot_ns, fingerprint
+                )
+            except OSError:
+                continue  # the parent directory will notice
+            kept = set(children)
+            for path in result.children[dirpath]:
+                if path not in kept:
+                    result.remove(path)
+            for f in found:
+                if not isinstance(f, FoundDir):
+                    continue
+                old = result.get(f.path)
+                if isinstance(old, FoundDir) and (
+                    f.path in gone or old.stat.st_ino != f.stat.st_ino
+                ):
+                    result.remove(f.path)  # removed and created again
+            result.children[dirpath] = children
+            result.invalidate(dirpath)
+            for f in found:
+                if f.file and f.path in result.children:
+                    result.remove(f.path)  # a directory replaced by a file
+                result[f.path] = f
+            for path, sub_full in subdirs:
+                if path not in result.children:
+                    result.children[path] = []
+                    new_dirs.append((path, sub_full))
+                    rescan.add(path)
+        while new_dirs:
+            path, full = new_dirs.pop()
+            new_dirs.extend(
+                result.add_scanned(
+                    *self._scan_dir(path, full, snapshot_ns, fingerprint)
+                )
+            )
+        for path in entries:
+            entry = result.get(path)
+            if entry is None:
                 continue
-            self._find_traverse(fn, result)
+            try:
+                st = os.stat(entry.full)
+            except OSError:
+                continue  # the parent directory will notice
+            if entry.dir:
+                result[path] = FoundDir(self.base_path, path, st=st)
+            else:
+                result[path] = FoundFile(
+                    self.base_path,
+                    path,
+                    self._fingerprint_for(path, fingerprint),
+                    snapshot_ns,
+                    self.hash_cache,
+                    st=st,
+                )
+            result.invalidate(os.path.dirname(path))
+        result.seal()
         return result
 
-    def _ignore_file(self, fn: str) -> bool:
-        if fn in self.ignore_paths:
-            return True
-        if self.ignore_hidden and os.path.basename(fn).startswith("."):
-            return True
-        return False
-
-    def _find_traverse(
+    def _remember_snapshot(
         self,
-        path: str,
-        result: Dict[str, Union["FoundDir", "FoundFile"]],
+        files: "_Snapshot",
+        dir_mtimes: Dict[str, int],
+        watch: Optional[Tuple[str, ...]],
     ) -> None:
-        full = os.path.join(self.base_path, path)
-        if os.path.isdir(full):
-            if not self.temp_path or path != "tmp":
-                result[path] = FoundDir(self.base_path, path)
-            for fn in os.listdir(full):
-                fn = os.path.join(path, fn)
-                if self._ignore_file(fn):
-                    continue
-                self._find_traverse(fn, result)
+        dir_mtimes.update(files.dir_mtimes())
+        with self._chain_lock:
+            self._last_snapshot = files
+            self._last_dir_mtimes = dir_mtimes
+            self._last_watch = watch
+
+    def _top_dir_mtimes(self) -> Dict[str, int]:
+        """
+        The ``st_mtime_ns`` of ``base_path`` and ``temp_path``, which have
+        no entry in the snapshots, by full path.
+        """
+        return {
+            path: os.stat(path).st_mtime_ns
+            for path in (self.base_path, self.temp_path)
+            if path and os.path.isdir(path)
+        }
+
+    def _invalidate_snapshot(self) -> None:
+        with self._chain_lock:
+            self._last_snapshot = None
+            self._last_dir_mtimes = {}
+
+    def _find_files(
+        self, watch: Optional[Tuple[str, ...]] = None, fingerprint: Optional[str] = None
+    ) -> "_Snapshot":
+        result = _Snapshot(self.base_path, self.hash_cache)
+        snapshot_ns = time.time_ns()
+        fingerprint = fingerprint or self.fingerprint
+        self._compile_ignore_rules()
+        if watch is None:
+            roots = [("", self.base_path)]
         else:
-            result[path] = FoundFile(self.base_path, path)
+            roots = self._add_watch_roots(result, watch, snapshot_ns, fingerprint)
+        if self.snapshot_workers > 1:
+            with ThreadPoolExecutor(self.snapshot_workers) as pool:
+                pending = {
+                    pool.submit(self._scan_dir, path, full, snapshot_ns, fingerprint)
+                    for path, full in roots
+                }
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for path, full in result.add_scanned(*future.result()):
+                            pending.add(
+                                pool.submit(
+                                    self._scan_dir, path, full, snapshot_ns, fingerprint
+                                )
+                            )
+        else:
+            dirs = roots
+            while dirs:
+                path, full = dirs.pop()
+                dirs.extend(
+                    result.add_scanned(
+                        *self._scan_dir(path, full, snapshot_ns, fingerprint)
+                    )
+                )
+        result.seal()
+        return result
+
+    def _add_watch_roots(
+        self,
+        result: "_Snapshot",
+        watch: Tuple[str, ...],
+        snapshot_ns: int,
+        fingerprint: str,
+    ) -> List[Tuple[str, str]]:
+        """
+        Add the watched paths to ``result``, along with the directories
+        leading to them (which are not tracked themselves).  Returns
+        the watched directories to scan.
+        """
+        roots = []
+        for path in watch:
+            full = os.path.join(self.base_path, path)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            parent = os.path.dirname(path)
+            child = path
+            while True:
+                siblings = result.children.setdefault(parent, [])
+                if child not in siblings:
+                    siblings.append(child)
+                if not parent:
+                    break
+                parent, child = os.path.dirname(parent), parent
+            if stat.S_ISDIR(st.st_mode):
+                result.children[path] = []
+                result[path] = FoundDir(self.base_path, path, st=st)
+                roots.append((path, full))
+            else:
+                result[path] = FoundFile(
+                    self.base_path,
+                    path,
+                    self._fingerprint_for(path, fingerprint),
+                    snapshot_ns,
+                    self.hash_cache,
+                    st=st,
+                )
+        return roots
+
+    def _compile_ignore_rules(self) -> None:
+        # Recompiled whenever the rules are changed on the instance
+        rules = (self.ignore_hidden, *self.ignore_paths)
+        if rules != self._ignore_rules:
+            self._ignore_matchers = _compile_ignore_rules(
+                self.ignore_paths, self.ignore_hidden
+            )
+            self._ignore_rules = rules
+        fingerprint_rules = tuple(self.fingerprint_paths.items())
+        if fingerprint_rules != self._fingerprint_rules:
+            self._fingerprint_matchers = [
+                (re.compile(_rule_regex(rule) + "$"), value)
+                for rule, value in fingerprint_rules
+            ]
+            self._fingerprint_rules = fingerprint_rules
+
+    def _fingerprint_for(self, path: str, fingerprint: str) -> str:
+        if self._fingerprint_matchers:
+            if os.sep != "/":
+                path = path.replace(os.sep, "/")
+            for regex, value in self._fingerprint_matchers:
+                if regex.match(path):
+                    return value
+        return fingerprint
+
+    def _ignore_file(self, fn: str, is_dir: bool = False) -> bool:
+        if os.sep != "/":
+            fn = fn.replace(os.sep, "/")
+        return self._ignore_matchers[is_dir].match(fn) is not None
+
+    def _scan_dir(
+        self, dirpath: str, full: str, snapshot_ns: int, fingerprint: str
+    ) -> Tuple[
+        str,
+        List[str],
+        List[Union["FoundDir", "FoundFile"]],
+        List[Tuple[str, str]],
+    ]:
+        """
+        List one directory.  Returns the directory, the paths of all the
+        entries in it, the entries found, and the subdirectories to
+        descend into as ``(path, full_path)`` pairs.
+        """
+        children = []
+        found: List[Union[FoundDir, FoundFile]] = []
+        subdirs = []
+        with os.scandir(full) as entries:
+            for entry in entries:
+                path = os.path.join(dirpath, entry.name) if dirpath else entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if self._ignore_file(path, is_dir):
+                    continue
+                children.append(path)
+                try:
+                    st: Optional[os.stat_result] = entry.stat()
+                except OSError:
+                    st = None  # e.g. a dangling symlink
+                if is_dir and st is not None:
+                    subdirs.append((path, entry.path))
+                    if not self.temp_path or path != "tmp":
+                        found.append(FoundDir(self.base_path, path, st=st))
+                else:
+                    found.append(
+                        FoundFile(
+                            self.base_path,
+                            path,
+                            self._fingerprint_for(path, fingerprint),
+                            snapshot_ns,
+                            self.hash_cache,
+                            st=st,
+                        )
+                    )
+        return dirpath, children, found, subdirs
 
     def clear(self, force: bool = False) -> None:
         """
-        Delete all the files in the base directory.
+        Delete all the files in the base directory (in the background
+        with ``background_clear``).
         """
+        self._invalidate_snapshot()
         marker_file = os.path.join(self.base_path, ".scripttest-test-dir.txt")
         if os.path.exists(self.base_path):
             if not force and not os.path.exists(marker_file):
@@ -315,7 +1471,10 @@ class TestFileEnvironment:
                     "The directory %s was not created by ScriptTest; it must "
                     "be deleted manually" % self.base_path
                 )
-            shutil.rmtree(self.base_path, onerror=onerror)
+            if self.background_clear:
+                _clear_later(self.base_path)
+            else:
+                shutil.rmtree(self.base_path, onerror=onerror)
         os.mkdir(self.base_path)
         f = open(marker_file, "w")
         f.write("placeholder")
@@ -334,21 +1493,192 @@ class TestFileEnvironment:
         that text is written, otherwise the file in ``frompath`` is
         used.  ``frompath`` is relative to ``self.template_path``
         """
+        self._invalidate_snapshot()
         full = os.path.join(self.base_path, path)
         if not os.path.exists(os.path.dirname(full)):
             os.makedirs(os.path.dirname(full))
+        if frompath is not None and self.template_path:
+            frompath = os.path.join(self.template_path, frompath)
+        if content is None and frompath is not None:
+            _copy_file(frompath, full)
+            return FoundFile(self.base_path, path)
         f = open(full, "wb")
         if content is not None:
             f.write(content)
         if frompath is not None:
-            if self.template_path:
-                frompath = os.path.join(self.template_path, frompath)
             f2 = open(frompath, "rb")
-            f.write(f2.read())
+            shutil.copyfileobj(f2, f, _HASH_CHUNK_SIZE)
             f2.close()
         f.close()
         return FoundFile(self.base_path, path)
 
+    def writefiles(
+        self,
+        files: Union[
+            Mapping[str, Union[bytes, str]], Iterable[Tuple[str, Union[bytes, str]]]
+        ],
+        workers: int = 1,
+    ) -> Mapping[str, "FoundFile"]:
+        """
+        Write many files at once.  ``files`` maps paths (relative to
+        ``base_path``) to their content, as bytes or as text written in
+        UTF-8, or is an iterable of such pairs.  The directories are
+        created first, each once, and with ``workers`` above 1 the files
+        are written on that many threads.
+
+        Returns a mapping of the paths to ``FoundFile`` objects, which
+        are only created when looked up.
+        """
+        if isinstance(files, Mapping):
+            files = files.items()
+        return self._write_files(
+            [
+                (
+                    path,
+                    content.encode("utf-8") if isinstance(content, str) else content,
+                    None,
+                )
+                for path, content in files
+            ],
+            (),
+            workers,
+        )
+
+    def writearchive(
+        self,
+        archive: Union[str, bytes, IO[bytes]],
+        path: str = "",
+        workers: int = 1,
+    ) -> Mapping[str, "FoundFile"]:
+        """
+        Write the files of a tar (possibly compressed) or zip ``archive``
+        under ``path``, like ``.writefiles()``, keeping their permission
+        bits.  ``archive`` is the name of the file (relative to
+        ``self.template_path``), its contents, or a binary file.  Links,
+        and members that would end up outside ``path``, raise a
+        ``ValueError``.
+        """
+        fileobj: IO[bytes]
+        if isinstance(archive, bytes):
+            fileobj = io.BytesIO(archive)
+        elif isinstance(archive, str):
+            if self.template_path:
+                archive = os.path.join(self.template_path, archive)
+            fileobj = open(archive, "rb")
+        else:
+            fileobj = archive
+        files: List[Tuple[str, builtins.bytes, Optional[int]]] = []
+        dirs = []
+        try:
+            if zipfile.is_zipfile(fileobj):
+                with zipfile.ZipFile(fileobj) as zf:
+                    for info in zf.infolist():
+                        name = _archive_path(path, info.filename)
+                        if info.is_dir():
+                            dirs.append(name)
+                        else:
+                            mode = info.external_attr >> 16
+                            if stat.S_IFMT(mode) not in (0, stat.S_IFREG):
+                                # e.g. a symbolic link, stored as its target
+                                raise ValueError(
+                                    "%s in the archive is not a file or directory"
+                                    % info.filename
+                                )
+                            files.append((name, zf.read(info), mode or None))
+            else:
+                fileobj.seek(0)
+                with tarfile.open(fileobj=fileobj) as tf:
+                    for member in tf:
+                        name = _archive_path(path, member.name)
+                        if member.isdir():
+                            dirs.append(name)
+                        elif member.isreg():
+                            f = tf.extractfile(member)
+                            assert f is not None
+                            files.append((name, f.read(), member.mode))
+                        else:
+                            raise ValueError(
+                                "%s in the archive is not a file or directory"
+                                % member.name
+                            )
+        finally:
+            if fileobj is not archive:
+                fileobj.close()
+        return self._write_files(files, dirs, workers)
+
+    def _write_files(
+        self,
+        files: List[Tuple[str, builtins.bytes, Optional[int]]],
+        dirs: Iterable[str],
+        workers: int,
+    ) -> Mapping[str, "FoundFile"]:
+        """Create ``dirs`` and write ``files`` (path, content and mode)."""
+        self._invalidate_snapshot()
+        needed = set()
+        for dirpath in list(dirs) + [os.path.dirname(f[0]) for f in files]:
+            while dirpath and dirpath not in needed:
+                needed.add(dirpath)
+                dirpath = os.path.dirname(dirpath)
+        for dirpath in sorted(needed, key=_path_depth):
+            try:
+                os.mkdir(os.path.join(self.base_path, dirpath))
+            except FileExistsError:
+                pass
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+        def write(file: Tuple[str, builtins.bytes, Optional[int]]) -> None:
+            path, content, mode = file
+            full = os.path.join(self.base_path, path)
+            fd = os.open(full, flags, 0o666)
+            try:
+                view = memoryview(content)
+                while view:
+                    view = view[os.write(fd, view) :]
+            finally:
+                os.close(fd)
+            if mode is not None:
+                os.chmod(full, stat.S_IMODE(mode))
+
+        if workers > 1 and len(files) > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                for _ in pool.map(write, files):
+                    pass
+        else:
+            for file in files:
+                write(file)
+        return _FoundFiles(self.base_path, [f[0] for f in files])
+
+    def copytree_from_template(
+        self, src: str, dest: str = "", mode: str = "auto"
+    ) -> "FoundDir":
+        """
+        Copy the directory ``src`` (relative to ``self.template_path``)
+        to ``dest`` (relative to ``base_path``, which is the default),
+        with the permissions of files and directories.
+
+        With ``mode="auto"`` (default) copies share the storage of the
+        template where the filesystem can (a reflink, on Linux), and are
+        otherwise made by the kernel without going through Python.
+        ``"copy"`` always makes real copies, and ``"hardlink"`` links the
+        files instead where possible, which is the fastest but only
+        suitable when neither the command nor the test writes to them.
+        """
+        if mode not in _COPY_MODES:
+            raise ValueError(
+                "mode must be one of %s, not %r" % (", ".join(_COPY_MODES), mode)
+            )
+        self._invalidate_snapshot()
+        if self.template_path:
+            src = os.path.join(self.template_path, src)
+        full = os.path.join(self.base_path, dest)
+
+        def copy(src: str, dest: str) -> None:
+            if not _copy_file(src, dest, mode):
+                shutil.copymode(src, dest)
+
+        shutil.copytree(src, full, copy_function=copy, dirs_exist_ok=True)
+        return FoundDir(self.base_path, dest)
+
     def assert_no_temp(self) -> None:
         """If you use ``capture_temp`` then you can use this to make
         sure no files have been left in the temporary directory"""
@@ -372,72 +1702,1456 @@ class TestFileEnvironment:
         raise AssertionError("Temporary files left over: %s" % ", ".join(sorted(names)))
 
 
-class ProcResult:
+class EnvironmentPool:
     """
-    Represents the results of running a command in
-    `TestFileEnvironment
-    <class-paste.fixture.TestFileEnvironment.html>`_.
-
-    Attributes to pay particular attention to:
-
-    ``stdout``, ``stderr``:
-        What is produced on those streams.
-
-    ``returncode``:
-        The return code of the script.
-
-    ``files_created``, ``files_deleted``, ``files_updated``:
-        Dictionaries mapping filenames (relative to the ``base_path``)
-        to `FoundFile <class-paste.fixture.FoundFile.html>`_ or
-        `FoundDir <class-paste.fixture.FoundDir.html>`_ objects.
+    Hands out ``TestFileEnvironment`` sandboxes that all start with the
+    same files, and puts a sandbox back in that state when it is
+    returned, by undoing only what changed since.
     """
 
     def __init__(
         self,
-        test_env: TestFileEnvironment,
-        args: List[str],
-        stdin: bytes,
-        stdout: str,
-        stderr: str,
-        returncode: int,
-        files_before: Dict[str, Union["FoundDir", "FoundFile"]],
-        files_after: Dict[str, Union["FoundDir", "FoundFile"]],
+        base_path: str,
+        setup: Optional[Callable[[TestFileEnvironment], Any]] = None,
+        template_path: Optional[str] = None,
+        **options: Any,
     ) -> None:
-        self.test_env = test_env
-        self.args = args
-        self.stdin = stdin
-        self.stdout = stdout
-        self.stderr = stderr
-        self.returncode = returncode
-        self.files_before = files_before
-        self.files_after = files_after
-        self.files_deleted = {}
-        self.files_updated = {}
-        self.files_created = files_after.copy()
-        for path, f in files_before.items():
-            if path not in files_after:
-                self.files_deleted[path] = f
-                continue
-            del self.files_created[path]
-            if f != files_after[path]:
-                self.files_updated[path] = files_after[path]
-        if sys.platform == "win32":
-            self.stdout = self.stdout.replace("\n\r", "\n")
-            self.stderr = self.stderr.replace("\n\r", "\n")
+        """
+        Sandboxes are created as needed in ``base_path`` (cleared like
+        the ``base_path`` of an environment), and ``setup(env)`` is
+        called to put the files of each new one in place.  The other
+        keyword arguments are passed to ``TestFileEnvironment``.
 
-    def assert_no_error(self, quiet: bool) -> None:
-        __tracebackhide__ = True
-        if self.returncode != 0:
-            if not quiet:
-                print(self)
-            raise AssertionError("Script returned code: %s" % self.returncode)
+        The contents of the files set up are copied once into a stash,
+        named by their hash, from which changed or deleted files are
+        restored.  Symbolic links are put back as links to the same
+        target; what is below a link to a directory, and files that are
+        neither regular files nor directories, are not restored.  Files
+        the environments ignore (see ``ignore_paths`` and
+        ``ignore_hidden``) are not restored either, but those created
+        since the setup are removed.  With
+        ``chain_snapshots`` the tree does not even need to be walked to
+        find what changed.
+        """
+        self.base_path = base_path
+        self.setup = setup
+        self.template_path = template_path
+        self.options = options
+        # Clears base_path, with the same safety check
+        TestFileEnvironment(
+            base_path, background_clear=options.get("background_clear", False)
+        )
+        self.stash_path = os.path.join(base_path, ".stash")
+        os.mkdir(self.stash_path)
+        self._free: List[TestFileEnvironment] = []
+        self._baselines: Dict[TestFileEnvironment, "_Baseline"] = {}
+        self._count = 0
+        self._lock = threading.Lock()
 
-    def assert_no_stderr(self, quiet: bool) -> None:
-        __tracebackhide__ = True
-        if self.stderr:
-            if not quiet:
-                print(self)
-            else:
+    def acquire(self) -> TestFileEnvironment:
+        """A pristine sandbox, new or reset, to give back with ``.release()``."""
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self._count += 1
+            path = os.path.join(self.base_path, "sandbox-%d" % self._count)
+        env = TestFileEnvironment(
+            path, template_path=self.template_path, **self.options
+        )
+        if self.setup is not None:
+            self.setup(env)
+        self._baselines[env] = self._record(env)
+        return env
+
+    def release(self, env: TestFileEnvironment) -> None:
+        """Reset ``env`` and make it available again."""
+        self.reset(env)
+        with self._lock:
+            self._free.append(env)
+
+    @contextlib.contextmanager
+    def sandbox(self) -> Iterator[TestFileEnvironment]:
+        """``.acquire()`` a sandbox for a ``with`` block."""
+        env = self.acquire()
+        try:
+            yield env
+        finally:
+            self.release(env)
+
+    def reset(self, env: TestFileEnvironment) -> None:
+        """Put the files of ``env`` back as they were after its setup."""
+        baseline = self._baselines[env]
+        files = env._snapshot_before(None, env.fingerprint)
+        files.settle(baseline.files)
+        created, deleted, updated = baseline.files.diff(files)
+        listings = self._remove_ignored(env, baseline)
+        if not (created or deleted or updated or listings):
+            return
+        for path in sorted(created, key=_path_depth):
+            listings.add(os.path.dirname(path))
+            full = os.path.join(env.base_path, path)
+            if os.path.isdir(full) and not os.path.islink(full):
+                shutil.rmtree(full, onerror=onerror)
+            elif os.path.lexists(full):
+                os.unlink(full)
+        entries = set()
+        for path in sorted(list(deleted) + list(updated), key=_path_depth):
+            if path in baseline.skipped:
+                continue
+            entries.add(path)
+            listings.add(os.path.dirname(path))
+            f = baseline.files[path]
+            full = os.path.join(env.base_path, path)
+            if path in baseline.links:
+                if os.path.isdir(full) and not os.path.islink(full):
+                    shutil.rmtree(full, onerror=onerror)
+                elif os.path.lexists(full):
+                    os.unlink(full)
+                os.symlink(baseline.links[path], full)
+                continue
+            if f.dir:
+                if os.path.lexists(full) and not os.path.isdir(full):
+                    os.unlink(full)
+                listings.add(path)
+                os.makedirs(full, exist_ok=True)
+            else:
+                if os.path.isdir(full) and not os.path.islink(full):
+                    shutil.rmtree(full, onerror=onerror)
+                elif os.path.lexists(full):
+                    os.unlink(full)
+                shutil.copyfile(
+                    os.path.join(self.stash_path, baseline.digests[path]), full
+                )
+            assert f.stat is not None
+            os.chmod(full, stat.S_IMODE(f.stat.st_mode))
+        # The directories changed too
+        entries.update(path for path in listings if path)
+        # The new baseline; the reset files all have new stat data
+        dir_mtimes = env._top_dir_mtimes()
+        baseline.files = env._patch_snapshot(
+            files, listings, entries, set(), env.fingerprint
+        )
+        baseline.dir_mtimes = dict(baseline.files.dir_mtimes())
+        baseline.dir_mtimes.update(dir_mtimes)
+        env._invalidate_snapshot()
+        if env.chain_snapshots:
+            env._remember_snapshot(baseline.files, dir_mtimes, None)
+
+    def _remove_ignored(
+        self, env: TestFileEnvironment, baseline: "_Baseline"
+    ) -> Set[str]:
+        """
+        Remove what the snapshots of ``env`` ignore (hidden files, by
+        default) and was not there after setup, from the directories of
+        the baseline whose modification time changed.  Returns those
+        directories.
+        """
+        changed = set()
+        for dirpath in baseline.files.children:
+            full = os.path.join(env.base_path, dirpath) if dirpath else env.base_path
+            try:
+                if os.stat(full).st_mtime_ns == baseline.dir_mtimes.get(full):
+                    continue
+                names = os.listdir(full)
+            except OSError:
+                continue  # deleted, and restored empty
+            changed.add(dirpath)
+            kept = baseline.ignored.get(dirpath, ())
+            for name in names:
+                path = os.path.join(dirpath, name) if dirpath else name
+                entry = os.path.join(full, name)
+                is_dir = os.path.isdir(entry) and not os.path.islink(entry)
+                if name in kept or not env._ignore_file(path, is_dir):
+                    continue
+                if is_dir:
+                    shutil.rmtree(entry, onerror=onerror)
+                else:
+                    os.unlink(entry)
+        return changed
+
+    def _record(self, env: TestFileEnvironment) -> "_Baseline":
+        """Snapshot the files of a new sandbox, and stash their contents."""
+        baseline = _Baseline()
+        dir_mtimes = env._top_dir_mtimes()
+        baseline.files = env._find_files()
+        baseline.dir_mtimes = dict(baseline.files.dir_mtimes())
+        baseline.dir_mtimes.update(dir_mtimes)
+        baseline.ignored = {}
+        for dirpath in baseline.files.children:
+            full = os.path.join(env.base_path, dirpath) if dirpath else env.base_path
+            names = {
+                name
+                for name in os.listdir(full)
+                if env._ignore_file(
+                    os.path.join(dirpath, name) if dirpath else name,
+                    os.path.isdir(os.path.join(full, name)),
+                )
+            }
+            if names:
+                baseline.ignored[dirpath] = names
+        baseline.digests = {}
+        baseline.links = {}
+        baseline.skipped = set()
+        for path in sorted(baseline.files, key=_path_depth):
+            f = baseline.files[path]
+            if os.path.dirname(path) in baseline.links or (
+                os.path.dirname(path) in baseline.skipped
+            ):
+                baseline.skipped.add(path)
+            elif os.path.islink(f.full):
+                baseline.links[path] = os.readlink(f.full)
+            elif f.file:
+                assert f.stat is not None
+                if stat.S_ISREG(f.stat.st_mode):
+                    baseline.digests[path] = self._stash(f.full)
+                else:
+                    baseline.skipped.add(path)  # e.g. a FIFO
+        if env.chain_snapshots:
+            env._remember_snapshot(baseline.files, dir_mtimes, None)
+        return baseline
+
+    def _stash(self, full: str) -> str:
+        """Copy the file ``full`` into the stash, and return its name there."""
+        fd, temp = tempfile.mkstemp(dir=self.stash_path)
+        h = hashlib.blake2b(digest_size=16)
+        with open(fd, "wb") as dest, open(full, "rb") as src:
+            while True:
+                chunk = src.read(_HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+                dest.write(chunk)
+        name = h.hexdigest()
+        if os.path.exists(os.path.join(self.stash_path, name)):
+            os.unlink(temp)
+        else:
+            os.replace(temp, os.path.join(self.stash_path, name))
+        return name
+
+
+class _Baseline:
+    """What a pooled sandbox is reset to."""
+
+    # The snapshot taken after setup, updated by each reset
+    files: "_Snapshot"
+    # The name in the stash of the contents of each file
+    digests: Dict[str, str]
+    # The target of each symbolic link
+    links: Dict[str, str]
+    # What can't be restored: special files, and what is below a link
+    skipped: Set[str]
+    # The st_mtime_ns of each directory, by full path
+    dir_mtimes: Dict[str, int]
+    # The names the snapshots ignore in each directory, that are kept
+    ignored: Dict[str, Set[str]]
+
+
+class CapturedOutput:
+    """
+    The output written by a command to one stream.  It is kept in
+    memory up to ``spill_size`` bytes, and in a temporary file past
+    that, so it can be searched and read line by line without holding
+    all of it in memory.
+    """
+
+    def __init__(self, spill_size: Optional[int] = None) -> None:
+        self.spill_size = spill_size
+        self._buffer = bytearray()
+        self._data: Optional[bytes] = None
+        self._file: Optional[IO[bytes]] = None
+        self._size = 0
+        self._closed = False
+
+    @classmethod
+    def _wrap(cls, output: Union[bytes, str, "CapturedOutput"]) -> "CapturedOutput":
+        if isinstance(output, CapturedOutput):
+            return output
+        captured = cls()
+        captured.write(output.encode("utf-8") if isinstance(output, str) else output)
+        captured.close()
+        return captured
+
+    @property
+    def spilled(self) -> bool:
+        """True if the output was moved to a temporary file."""
+        return self._file is not None
+
+    def write(self, data: bytes) -> None:
+        if self._closed:
+            return  # read after the command was given up on
+        self._size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._buffer += data
+        if self.spill_size is not None and len(self._buffer) > self.spill_size:
+            self._file = tempfile.TemporaryFile(prefix="scripttest-output-")
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def close(self) -> None:
+        """Called once the command closed the stream, or was given up on."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is not None:
+            self._file.flush()
+        else:
+            self._data = bytes(self._buffer)
+            self._buffer = bytearray()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _view(self) -> _Buffer:
+        if self._file is None:
+            assert self._data is not None
+            return self._data
+        if not self._size:
+            return b""
+        # The mapping stays open as long as something refers to it
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def getvalue(self) -> bytes:
+        """All of the output, read into memory."""
+        if self._file is None:
+            assert self._data is not None
+            return self._data
+        self._file.seek(0)
+        return self._file.read()
+
+    def _read(self, offset: int, size: int) -> bytes:
+        if self._file is None:
+            assert self._data is not None
+            return self._data[offset : offset + size]
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def iter_chunks(self, size: int = 65536) -> Iterator[bytes]:
+        """The output in pieces of at most ``size`` bytes."""
+        for offset in range(0, self._size, size):
+            yield self._read(offset, size)
+
+    def iter_lines(self) -> Iterator[str]:
+        """The decoded lines of the output, without their line endings."""
+        pending: List[bytes] = []
+        for chunk in self.iter_chunks():
+            end = chunk.rfind(b"\n")
+            if end == -1:
+                pending.append(chunk)
+                continue
+            pending.append(chunk[:end])
+            for line in b"".join(pending).split(b"\n"):
+                yield _decode_line(line)
+            pending = [chunk[end + 1 :]]
+        rest = b"".join(pending)
+        if rest:
+            yield _decode_line(rest)
+
+    def tail(self, n: int = 10) -> List[str]:
+        """The last ``n`` lines of the output."""
+        if n <= 0:
+            return []
+        start = self._size
+        block = b""
+        # One newline more than needed, as the output may end with one
+        while start and block.count(b"\n") <= n:
+            size = min(65536, start)
+            start -= size
+            block = self._read(start, size) + block
+        lines = block.split(b"\n")
+        if not lines[-1]:
+            lines.pop()
+        return [_decode_line(line) for line in lines[-n:]]
+
+    def search(self, pattern: _SearchPattern) -> Optional[Match[bytes]]:
+        """
+        Search the output for ``pattern``: a string or bytes to find
+        literally, or a compiled bytes regular expression.
+        """
+        return _search_pattern(pattern).search(self._view())
+
+    def __contains__(self, pattern: _SearchPattern) -> bool:
+        return self.search(pattern) is not None
+
+    def __repr__(self) -> str:
+        return "<%s %s bytes%s>" % (
+            self.__class__.__name__,
+            self._size,
+            " (spilled)" if self.spilled else "",
+        )
+
+
+def _capture(
+    proc: "subprocess.Popen[bytes]",
+    stdin: Optional[bytes],
+    spill_size: Optional[int],
+    timeout: Optional[float] = None,
+    grace: float = 5.0,
+) -> Tuple[CapturedOutput, CapturedOutput, Any, bool]:
+    """
+    Feed ``stdin`` to ``proc`` and read its output as it comes, then
+    wait for it to exit.  Past ``timeout`` seconds its process group is
+    stopped (see ``_stop()``).  Returns the output, the resource usage
+    and whether the command timed out.
+    """
+    assert proc.stdin and proc.stdout and proc.stderr
+    stdout = CapturedOutput(spill_size)
+    stderr = CapturedOutput(spill_size)
+    threads = [threading.Thread(target=_pump, args=(proc.stderr, stderr))]
+    if stdin:
+        threads.append(threading.Thread(target=_feed, args=(proc.stdin, stdin)))
+    else:
+        proc.stdin.close()
+    if timeout is not None:
+        threads.append(threading.Thread(target=_pump, args=(proc.stdout, stdout)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    if timeout is None:
+        _pump(proc.stdout, stdout)
+        for thread in threads:
+            thread.join()
+        return stdout, stderr, _wait(proc), False
+    deadline = time.monotonic() + timeout
+    rusage, timed_out = _wait_or_stop(proc, deadline, grace)
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    if any(thread.is_alive() for thread in threads):
+        # Something the command started still holds the pipes open
+        _signal_group(proc, kill=True)
+        for thread in threads:
+            thread.join(grace)
+    # Keep what was read so far, even if a pipe is still open
+    stdout.close()
+    stderr.close()
+    return stdout, stderr, rusage, timed_out
+
+
+async def _acapture(
+    proc: "asyncio.subprocess.Process",
+    stdin: Optional[bytes],
+    stdout: CapturedOutput,
+    stderr: CapturedOutput,
+) -> None:
+    """Like ``_capture()``, for a process started with ``asyncio``."""
+    assert proc.stdin and proc.stdout and proc.stderr
+
+    async def feed(pipe: asyncio.StreamWriter) -> None:
+        try:
+            if stdin:
+                pipe.write(stdin)
+                await pipe.drain()
+            pipe.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # The command exited without reading all of its input
+            pass
+
+    async def pump(pipe: asyncio.StreamReader, output: CapturedOutput) -> None:
+        try:
+            while True:
+                data = await pipe.read(65536)
+                if not data:
+                    break
+                output.write(data)
+        finally:
+            output.close()
+
+    await asyncio.gather(
+        feed(proc.stdin), pump(proc.stdout, stdout), pump(proc.stderr, stderr)
+    )
+
+
+async def _astop_on_timeout(
+    proc: "asyncio.subprocess.Process", timeout: Optional[float], grace: float
+) -> bool:
+    """Like ``_wait_or_stop()``, for a process started with ``asyncio``."""
+    if timeout is None:
+        return False
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+        return False
+    except asyncio.TimeoutError:
+        pass
+    _signal_group(proc, kill=False)
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        pass
+    _signal_group(proc, kill=True)
+    return True
+
+
+def _wait(proc: Any, deadline: Optional[float] = None) -> Any:
+    """
+    Wait for ``proc`` to exit, raising ``subprocess.TimeoutExpired`` if
+    it still runs at ``deadline`` (a ``time.monotonic()`` value).
+    Returns its resource usage where the platform reports it, else None.
+    """
+    if isinstance(proc, _ForkedProcess):
+        return proc.wait4(deadline)
+    if not hasattr(os, "wait4"):
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        proc.wait(timeout)
+        return None
+    try:
+        if deadline is None:
+            _, status, rusage = os.wait4(proc.pid, 0)
+        else:
+            # Poll like Popen.wait() does, as wait4 can't time out
+            delay = 0.0005
+            while True:
+                pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+                if pid:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(proc.args, 0)
+                delay = min(delay * 2, remaining, 0.05)
+                time.sleep(delay)
+    except ChildProcessError:
+        proc.wait()  # reaped by someone else
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def _wait_or_stop(
+    proc: "subprocess.Popen[bytes]", deadline: Optional[float], grace: float
+) -> Tuple[Any, bool]:
+    """
+    Wait for ``proc`` to exit until ``deadline``, then stop its process
+    group: SIGTERM first, and SIGKILL if it is still there ``grace``
+    seconds later.  Returns the resource usage and whether it timed out.
+    """
+    try:
+        return _wait(proc, deadline), False
+    except subprocess.TimeoutExpired:
+        pass
+    _signal_group(proc, kill=False)
+    try:
+        rusage = _wait(proc, time.monotonic() + grace)
+    except subprocess.TimeoutExpired:
+        _signal_group(proc, kill=True)
+        rusage = _wait(proc)
+    # Anything the command started that ignored SIGTERM
+    _signal_group(proc, kill=True)
+    return rusage, True
+
+
+def _signal_group(proc: Any, kill: bool) -> None:
+    """
+    Terminate (or kill) the process group of ``proc``, which was started
+    in a session of its own.  Works with ``subprocess.Popen`` and
+    ``asyncio`` processes.
+    """
+    try:
+        if sys.platform == "win32":
+            if kill:
+                proc.kill()
+            else:
+                proc.terminate()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL if kill else signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass  # already gone
+
+
+def _rusage_metrics(rusage: Any) -> Dict[str, float]:
+    if rusage is None:
+        return {}
+    return {
+        "user_cpu": rusage.ru_utime,
+        "system_cpu": rusage.ru_stime,
+        # Linux reports kilobytes, macOS bytes
+        "max_rss": rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "voluntary_switches": rusage.ru_nvcsw,
+        "involuntary_switches": rusage.ru_nivcsw,
+    }
+
+
+def _format_metrics(metrics: Mapping[str, float]) -> str:
+    parts = []
+    for name, value in metrics.items():
+        if name == "max_rss":
+            parts.append("%s %.1fMiB" % (name, value / (1024 * 1024)))
+        elif name.endswith("_switches"):
+            parts.append("%s %d" % (name, value))
+        else:
+            parts.append("%s %.3fs" % (name, value))
+    return ", ".join(parts)
+
+
+def _pump(pipe: IO[bytes], output: CapturedOutput) -> None:
+    try:
+        while True:
+            data = os.read(pipe.fileno(), 65536)
+            if not data:
+                break
+            output.write(data)
+    finally:
+        pipe.close()
+        output.close()
+
+
+def _feed(pipe: IO[bytes], data: bytes) -> None:
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        # The command exited without reading all of its input
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _search_pattern(pattern: _SearchPattern) -> Pattern[bytes]:
+    if isinstance(pattern, str):
+        pattern = pattern.encode("utf-8")
+    if isinstance(pattern, bytes):
+        return re.compile(re.escape(pattern))
+    return pattern
+
+
+def _python_environ(environ: Mapping[str, str]) -> Dict[str, str]:
+    """The variables of ``environ`` that change how Python starts."""
+    return {k: v for k, v in environ.items() if k.startswith("PYTHON")}
+
+
+def _forkable_python(args: Sequence[str]) -> bool:
+    """
+    Whether ``args`` runs ``sys.executable`` in a way a fork server child
+    can reproduce: ``-c code``, ``-m module`` or a script, plus arguments.
+    """
+    if len(args) < 2 or args[0] != sys.executable:
+        return False
+    if args[1] in ("-c", "-m"):
+        return len(args) > 2
+    return not args[1].startswith("-")
+
+
+class _ForkServer:
+    """
+    A Python process with some modules imported, that forks a child to
+    run each Python command it is sent.  Requests go over a socket, with
+    the child's standard streams passed along as file descriptors; each
+    request gets a socket of its own where the server sends the child's
+    pid, then its exit status and resource usage.
+    """
+
+    def __init__(self, preload: Sequence[str], environ: Dict[str, str], cwd: str):
+        self.python_environ = _python_environ(environ)
+        self.lock = threading.Lock()
+        self.sock, theirs = socket.socketpair()
+        code = (
+            "import sys; sys.path.insert(0, %r); import scripttest; "
+            "del sys.path[0]; scripttest._forkserver_main(%d, %r)"
+            % (
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                theirs.fileno(),
+                list(preload),
+            )
+        )
+        try:
+            self.proc = subprocess.Popen(
+                [sys.executable, "-c", code],
+                stdin=subprocess.DEVNULL,
+                cwd=cwd,
+                env=environ,
+                pass_fds=(theirs.fileno(),),
+            )
+        finally:
+            theirs.close()
+        if self.sock.recv(6) != b"ready\n":
+            self.close()
+            raise OSError("the fork server could not start")
+        atexit.register(self.close)
+
+    def spawn(
+        self,
+        argv: List[str],
+        cwd: str,
+        environ: Dict[str, str],
+        limits: Dict[str, float],
+    ) -> "_ForkedProcess":
+        """Start ``python argv`` in a new child, with pipes for its streams."""
+        stdin, stdin_w = os.pipe()
+        stdout_r, stdout = os.pipe()
+        stderr_r, stderr = os.pipe()
+        status, theirs = socket.socketpair()
+        request = json.dumps(
+            {"argv": argv, "cwd": cwd, "environ": environ, "limits": limits}
+        ).encode("utf-8")
+        data = struct.pack("!I", len(request)) + request
+        fds = array("i", [stdin, stdout, stderr, theirs.fileno()])
+        try:
+            with self.lock:
+                sent = self.sock.sendmsg(
+                    [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+                )
+                self.sock.sendall(data[sent:])
+        except OSError:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            status.close()
+            raise
+        finally:
+            for fd in (stdin, stdout, stderr):
+                os.close(fd)
+            theirs.close()
+        return _ForkedProcess(argv, status, stdin_w, stdout_r, stderr_r)
+
+    def close(self) -> None:
+        """Stop the server; children still running are left alone."""
+        atexit.unregister(self.close)
+        self.sock.close()
+        try:
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+# The running fork servers, by preloaded modules and PYTHON* variables;
+# environments that agree on those share a server until the interpreter exits
+_forkservers: Dict[Tuple[Tuple[str, ...], Tuple[Tuple[str, str], ...]], _ForkServer] = (
+    {}
+)
+_forkservers_lock = threading.Lock()
+
+
+class _ChildProcess:
+    """
+    A forked child running in a session of its own, with what
+    ``_capture()`` uses of ``subprocess.Popen``.
+    """
+
+    def __init__(self, args: List[str], pid: int, stdin: int, stdout: int, stderr: int):
+        self.args = args
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self.stdin = os.fdopen(stdin, "wb")
+        self.stdout = os.fdopen(stdout, "rb")
+        self.stderr = os.fdopen(stderr, "rb")
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        """Only used once the child was reaped elsewhere, like Popen."""
+        if self.returncode is None:
+            self.returncode = 0
+        return self.returncode
+
+    def terminate(self) -> None:
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+    def kill(self) -> None:
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+
+def _fork_child(
+    args: List[str],
+    cwd: str,
+    environ: Dict[str, str],
+    limits: Dict[str, float],
+    main: Callable[[], int],
+) -> _ChildProcess:
+    """Fork a child that runs ``main()`` (see ``_child_main()``)."""
+    stdin, stdin_w = os.pipe()
+    stdout_r, stdout = os.pipe()
+    stderr_r, stderr = os.pipe()
+    try:
+        pid = os.fork()
+    except OSError:
+        for fd in (stdin, stdin_w, stdout_r, stdout, stderr_r, stderr):
+            os.close(fd)
+        raise
+    if not pid:
+        for fd in (stdin_w, stdout_r, stderr_r):
+            os.close(fd)
+        # The exit handlers so far belong to the test process, e.g. the
+        # cleanup of its temporary directories
+        atexit._clear()
+        _child_main([stdin, stdout, stderr], cwd, environ, limits, main)
+    for fd in (stdin, stdout, stderr):
+        os.close(fd)
+    return _ChildProcess(args, pid, stdin_w, stdout_r, stderr_r)
+
+
+class _ForkedProcess(_ChildProcess):
+    """A child of a ``_ForkServer``, which reaps it for us."""
+
+    def __init__(
+        self,
+        args: List[str],
+        status: socket.socket,
+        stdin: int,
+        stdout: int,
+        stderr: int,
+    ):
+        self.args = args
+        self._status = status
+        self._buffer = b""
+        try:
+            message = self._receive(None)
+            if "error" in message:
+                raise OSError(message["error"])
+        except BaseException:
+            for fd in (stdin, stdout, stderr):
+                os.close(fd)
+            status.close()
+            raise
+        super().__init__(args, message["pid"], stdin, stdout, stderr)
+
+    def _receive(self, deadline: Optional[float]) -> Dict[str, Any]:
+        """Read the next message from the server."""
+        while b"\n" not in self._buffer:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise subprocess.TimeoutExpired(self.args, 0)
+            self._status.settimeout(timeout)
+            try:
+                data = self._status.recv(4096)
+            except socket.timeout:
+                raise subprocess.TimeoutExpired(self.args, 0)
+            if not data:
+                raise OSError("the fork server went away")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        message: Dict[str, Any] = json.loads(line)
+        return message
+
+    def wait4(self, deadline: Optional[float] = None) -> Any:
+        """Like ``_wait()``."""
+        message = self._receive(deadline)
+        self._status.close()
+        status = message["status"]
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        return types.SimpleNamespace(**message["rusage"])
+
+
+def _forkserver_main(fd: int, preload: List[str]) -> None:
+    """The loop of a ``_ForkServer`` process, talking over socket ``fd``."""
+    control = socket.socket(fileno=fd)
+    for name in preload:
+        __import__(name)
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    control.sendall(b"ready\n")
+    children: Dict[int, socket.socket] = {}
+    while True:
+        readable = select.select([control.fileno(), wakeup_r], [], [])[0]
+        if wakeup_r in readable:
+            while True:
+                try:
+                    if not os.read(wakeup_r, 4096):
+                        break
+                except BlockingIOError:
+                    break
+        while children:
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            if not pid:
+                break
+            _send_message(
+                children.pop(pid),
+                {
+                    "status": status,
+                    "rusage": {
+                        name: getattr(rusage, name)
+                        for name in (
+                            "ru_utime",
+                            "ru_stime",
+                            "ru_maxrss",
+                            "ru_nvcsw",
+                            "ru_nivcsw",
+                        )
+                    },
+                },
+            )
+        if control.fileno() not in readable:
+            continue
+        request = _receive_request(control)
+        if request is None:
+            # Whoever started us is gone
+            break
+        options, fds = request
+        status_sock = socket.socket(fileno=fds.pop())
+        try:
+            pid = os.fork()
+        except OSError as e:
+            _send_message(status_sock, {"error": str(e)})
+        else:
+            if not pid:
+                inherited = [control.fileno(), wakeup_r, wakeup_w, status_sock.fileno()]
+                inherited.extend(sock.fileno() for sock in children.values())
+                for inherited_fd in inherited:
+                    os.close(inherited_fd)
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _child_main(
+                    fds,
+                    options["cwd"],
+                    options["environ"],
+                    options["limits"],
+                    lambda: _python_main(options["argv"]),
+                )
+            children[pid] = status_sock
+            status_sock.sendall(b'{"pid": %d}\n' % pid)
+        finally:
+            for child_fd in fds:
+                os.close(child_fd)
+
+
+def _receive_request(sock: socket.socket) -> Optional[Tuple[Dict[str, Any], List[int]]]:
+    """
+    Read a request sent by ``_ForkServer.spawn()``, with its file
+    descriptors, or None at the end of the stream.
+    """
+    fds = array("i")
+    data, ancdata, _, _ = sock.recvmsg(4, socket.CMSG_SPACE(4 * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[: len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    if not data:
+        return None
+    while len(data) < 4:
+        data += sock.recv(4 - len(data))
+    (length,) = struct.unpack("!I", data)
+    body = b""
+    while len(body) < length:
+        chunk = sock.recv(length - len(body))
+        if not chunk:
+            return None
+        body += chunk
+    return json.loads(body), list(fds)
+
+
+def _send_message(sock: socket.socket, message: Dict[str, Any]) -> None:
+    try:
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+    except OSError:
+        pass  # the caller gave up on it
+    sock.close()
+
+
+def _child_main(
+    fds: List[int],
+    cwd: str,
+    environ: Dict[str, str],
+    limits: Mapping[str, float],
+    main: Callable[[], int],
+) -> NoReturn:
+    """
+    Set up a forked child to look like a new process, with the standard
+    streams ``fds``, run ``main()`` and exit with the code it returns.
+    Never returns.
+    """
+    code = 1
+    try:
+        os.setsid()
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        if limits:
+            _set_limits(limits)
+        encoding = sys.stdout.encoding
+        errors = sys.stdout.errors
+        sys.stdin = io.TextIOWrapper(open(0, "rb", closefd=False), encoding, errors)
+        sys.stdout = io.TextIOWrapper(open(1, "wb", closefd=False), encoding, errors)
+        sys.stderr = io.TextIOWrapper(
+            open(2, "wb", closefd=False),
+            encoding,
+            "backslashreplace",
+            line_buffering=True,
+        )
+        code = main()
+        # What the interpreter does on the way out
+        threading_shutdown = getattr(threading, "_shutdown", None)
+        if threading_shutdown is not None:
+            threading_shutdown()
+        atexit._run_exitfuncs()
+        for stream in (sys.stdout, sys.stderr):
+            if not stream.closed:
+                stream.flush()
+    except BaseException:
+        try:
+            traceback.print_exc()
+            sys.stderr.flush()
+        except BaseException:
+            pass
+    finally:
+        os._exit(code)
+
+
+def _python_main(argv: List[str]) -> int:
+    """
+    Run ``python argv`` (see ``_forkable_python()``) in this process, and
+    return its exit code.
+    """
+
+    def main() -> None:
+        if argv[0] == "-c":
+            sys.argv = ["-c"] + argv[2:]
+            module = types.ModuleType("__main__")
+            sys.modules["__main__"] = module
+            exec(compile(argv[1], "<string>", "exec"), module.__dict__)
+        elif argv[0] == "-m":
+            sys.argv = argv[1:]
+            # The module may be one the fork server preloaded
+            _run_module_as_main(argv[1])
+        else:
+            sys.argv = list(argv)
+            sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+            runpy.run_path(argv[0], run_name="__main__")
+
+    return _run_main(main)
+
+
+def _run_module_as_main(name: str) -> None:
+    """
+    ``runpy.run_module()`` the way ``python -m`` does, without warning
+    that the module was already imported.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings(
+            "ignore", re.escape("'%s' found in sys.modules" % name), RuntimeWarning
+        )
+        runpy.run_module(name, run_name="__main__", alter_sys=True)
+
+
+def _run_python_target(target: str, args: List[str]) -> int:
+    """
+    Run the ``.run_python()`` ``target`` with ``args`` in this process,
+    and return its exit code.
+    """
+
+    def main() -> None:
+        entry_point = target if ":" in target else _console_script(target)
+        if entry_point is None:
+            sys.argv = [target] + args
+            # It may have been imported by an earlier call
+            _run_module_as_main(target)
+            return
+        if entry_point == target:
+            sys.argv = [target] + args
+        else:
+            # Console scripts see the path they were started with
+            sys.argv = [shutil.which(target) or target] + args
+        module_name, _, attrs = entry_point.partition(":")
+        func: Any = importlib.import_module(module_name.strip())
+        for attr in attrs.split("[")[0].strip().split("."):
+            func = getattr(func, attr)
+        # What the scripts pip installs do
+        sys.exit(func())
+
+    return _run_main(main)
+
+
+def _console_script(name: str) -> Optional[str]:
+    """The ``module:attr`` of the installed console script ``name``."""
+    return _console_scripts(_import_path_state()).get(name)
+
+
+@functools.lru_cache(maxsize=1)
+def _console_scripts(path_state: Tuple[Tuple[str, int], ...]) -> Dict[str, str]:
+    """
+    The ``module:attr`` of every console script installed, by name.
+    Scanning the distributions is slow, so this is cached for as long
+    as ``path_state`` stays the same.
+    """
+    import importlib.metadata
+
+    entry_points: Any = importlib.metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        found = entry_points.select(group="console_scripts")
+    else:  # Python < 3.10
+        found = entry_points.get("console_scripts", ())
+    scripts: Dict[str, str] = {}
+    for entry_point in found:
+        scripts.setdefault(entry_point.name, entry_point.value)
+    return scripts
+
+
+def _import_path_state() -> Tuple[Tuple[str, int], ...]:
+    """
+    ``sys.path`` with the ``st_mtime_ns`` of each directory, which
+    changes when a distribution is installed into it or removed.
+    """
+    state = []
+    for entry in sys.path:
+        try:
+            # Not the current directory, which runs keep changing
+            mtime_ns = os.stat(entry).st_mtime_ns if entry else 0
+        except OSError:
+            mtime_ns = 0
+        state.append((entry, mtime_ns))
+    return tuple(state)
+
+
+def _run_main(main: Callable[[], None]) -> int:
+    """
+    Call ``main()`` and return the exit code the interpreter would
+    have, printing uncaught exceptions like it does.
+    """
+    try:
+        main()
+    except SystemExit as e:
+        return _exit_code(e)
+    except BaseException:
+        exc_type, exc, tb = sys.exc_info()
+        assert exc_type is not None and exc is not None
+        # Leave scripttest's frames out, as the interpreter would
+        while tb is not None and tb.tb_frame.f_code.co_filename == __file__:
+            tb = tb.tb_next
+        sys.excepthook(exc_type, exc.with_traceback(tb), tb)
+        return 1
+    return 0
+
+
+class _OutputWriter(io.RawIOBase):
+    """
+    Where ``.run_python()`` sends the standard streams.  Once the call
+    is over ``output`` is set to None and further writes are dropped.
+    """
+
+    def __init__(self, output: CapturedOutput) -> None:
+        self.output: Optional[CapturedOutput] = output
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        if self.output is not None:
+            self.output.write(bytes(data))
+        return len(data)
+
+
+# Held while .run_python() switches the process-wide state
+_inline_lock = threading.Lock()
+
+
+def _exit_code(e: SystemExit) -> int:
+    """The exit code ``e`` makes the interpreter exit with."""
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code & 0xFF
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+# Return codes of a command killed by RLIMIT_CPU, soft then hard limit
+_CPU_LIMIT_SIGNALS = tuple(
+    -getattr(signal, name) for name in ("SIGXCPU", "SIGKILL") if hasattr(signal, name)
+)
+
+
+class _Invocation:
+    """The options of one run, once checked."""
+
+    args: List[str]
+    cwd: Optional[str]
+    stdin: Optional[bytes]
+    expect_error: bool
+    expect_stderr: bool
+    expect_temp: bool
+    quiet: bool
+    debug: bool
+    watch: Optional[Tuple[str, ...]]
+    snapshot: bool
+    fingerprint: str
+    timings: Dict[str, float]
+    metrics: Dict[str, float]
+    budget: Dict[str, Optional[float]]
+    enforce_limits: bool
+    timeout: Optional[float]
+    timeout_grace: float
+    timed_out: bool
+    # "inline" or "isolate" for .run_python()
+    in_process: Optional[str]
+    # False when the caller checks the expectations itself
+    check: bool
+
+    def limits(self) -> Dict[str, float]:
+        """The resource limits to set in the child, if any."""
+        if not self.enforce_limits or resource is None:
+            return {}
+        limits = {}
+        for name in ("cpu", "rss"):
+            value = self.budget[name]
+            if value is not None:
+                limits[name] = value
+        return limits
+
+    def preexec_fn(self) -> Optional[Callable[[], None]]:
+        """What to run in the child to apply the resource limits."""
+        limits = self.limits()
+        if not limits:
+            return None
+        return lambda: _set_limits(limits)
+
+
+def _set_limits(limits: Mapping[str, float]) -> None:
+    """Apply ``limits`` (see ``_Invocation.limits()``) to this process."""
+    assert resource is not None
+    if "cpu" in limits:
+        # SIGXCPU at the soft limit, SIGKILL at the hard one
+        seconds = int(math.ceil(limits["cpu"]))
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+    if "rss" in limits:
+        rss = int(limits["rss"])
+        resource.setrlimit(resource.RLIMIT_AS, (rss, rss))
+
+
+class ProcResult:
+    """
+    Represents the results of running a command in
+    `TestFileEnvironment
+    <class-paste.fixture.TestFileEnvironment.html>`_.
+
+    Attributes to pay particular attention to:
+
+    ``stdout``, ``stderr``:
+        What is produced on those streams.  ``stdout_bytes`` and
+        ``stderr_bytes`` hold the output as it was read, and
+        ``stdout_stream`` and ``stderr_stream`` are `CapturedOutput
+        <class-paste.fixture.CapturedOutput.html>`_ objects that can be
+        searched without reading all of a large output into memory.
+
+    ``returncode``:
+        The return code of the script.
+
+    ``timed_out``:
+        True if the script was stopped because it ran past its timeout.
+
+    ``files_created``, ``files_deleted``, ``files_updated``:
+        Dictionaries mapping filenames (relative to the ``base_path``)
+        to `FoundFile <class-paste.fixture.FoundFile.html>`_ or
+        `FoundDir <class-paste.fixture.FoundDir.html>`_ objects.
+
+    ``metrics``:
+        What the command used: ``wall`` time, and where the platform
+        reports it ``user_cpu`` and ``system_cpu`` time (all in
+        seconds), ``max_rss`` (peak resident memory, in bytes) and
+        ``voluntary_switches`` and ``involuntary_switches`` (context
+        switches).
+
+    ``timings``:
+        The time (in seconds) scripttest itself spent on
+        ``snapshot_before``, ``spawn``, ``communicate``,
+        ``snapshot_after`` and, once files are compared, ``diff``.
+
+    The output is decoded, and the files compared, the first time they
+    are used.  Unless ``keep_snapshots`` is true, ``files_before`` and
+    ``files_after`` are let go once the files have been compared.
+    """
+
+    def __init__(
+        self,
+        test_env: TestFileEnvironment,
+        args: List[str],
+        stdin: Optional[bytes],
+        stdout: Union[bytes, str, "CapturedOutput"],
+        stderr: Union[bytes, str, "CapturedOutput"],
+        returncode: int,
+        files_before: Mapping[str, Union["FoundDir", "FoundFile"]],
+        files_after: Mapping[str, Union["FoundDir", "FoundFile"]],
+        keep_snapshots: bool = True,
+        metrics: Optional[Dict[str, float]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        timed_out: bool = False,
+    ) -> None:
+        self.test_env = test_env
+        self.args = args
+        self.stdin = stdin
+        self.stdout_stream = CapturedOutput._wrap(stdout)
+        self.stderr_stream = CapturedOutput._wrap(stderr)
+        self._stdout = stdout if isinstance(stdout, str) else None
+        self._stderr = stderr if isinstance(stderr, str) else None
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self._files_before: Optional[Mapping[str, Union[FoundDir, FoundFile]]]
+        self._files_after: Optional[Mapping[str, Union[FoundDir, FoundFile]]]
+        self._files_before = files_before
+        self._files_after = files_after
+        self.keep_snapshots = keep_snapshots
+        self.metrics = metrics or {}
+        self.timings = timings or {}
+        self._diff: Optional[
+            Tuple[
+                Dict[str, Union[FoundDir, FoundFile]],
+                Dict[str, Union[FoundDir, FoundFile]],
+                Dict[str, Union[FoundDir, FoundFile]],
+            ]
+        ] = None
+
+    @property
+    def stdout_bytes(self) -> bytes:
+        return self.stdout_stream.getvalue()
+
+    @property
+    def stderr_bytes(self) -> bytes:
+        return self.stderr_stream.getvalue()
+
+    @property
+    def stdout(self) -> str:
+        if self._stdout is None:
+            self._stdout = _decode_output(self.stdout_bytes)
+        return self._stdout
+
+    @stdout.setter
+    def stdout(self, value: str) -> None:
+        self._stdout = value
+
+    @property
+    def stderr(self) -> str:
+        if self._stderr is None:
+            self._stderr = _decode_output(self.stderr_bytes)
+        return self._stderr
+
+    @stderr.setter
+    def stderr(self, value: str) -> None:
+        self._stderr = value
+
+    @property
+    def files_before(self) -> Mapping[str, Union["FoundDir", "FoundFile"]]:
+        if self._files_before is None:
+            raise AttributeError(
+                "files_before is not kept once files are compared; use "
+                "TestFileEnvironment(keep_snapshots=True)"
+            )
+        return self._files_before
+
+    @property
+    def files_after(self) -> Mapping[str, Union["FoundDir", "FoundFile"]]:
+        if self._files_after is None:
+            raise AttributeError(
+                "files_after is not kept once files are compared; use "
+                "TestFileEnvironment(keep_snapshots=True)"
+            )
+        return self._files_after
+
+    @property
+    def files_created(self) -> Dict[str, Union["FoundDir", "FoundFile"]]:
+        return self._compare_files()[0]
+
+    @property
+    def files_deleted(self) -> Dict[str, Union["FoundDir", "FoundFile"]]:
+        return self._compare_files()[1]
+
+    @property
+    def files_updated(self) -> Dict[str, Union["FoundDir", "FoundFile"]]:
+        return self._compare_files()[2]
+
+    def _compare_files(
+        self,
+    ) -> Tuple[
+        Dict[str, Union["FoundDir", "FoundFile"]],
+        Dict[str, Union["FoundDir", "FoundFile"]],
+        Dict[str, Union["FoundDir", "FoundFile"]],
+    ]:
+        if self._diff is not None:
+            return self._diff
+        started = time.perf_counter()
+        files_before = self.files_before
+        files_after = self.files_after
+        if isinstance(files_before, _Snapshot) and isinstance(files_after, _Snapshot):
+            self._diff = files_before.diff(files_after)
+        else:
+            files_deleted = {}
+            files_updated = {}
+            files_created = dict(files_after)
+            for path, f in files_before.items():
+                if path not in files_after:
+                    files_deleted[path] = f
+                    continue
+                del files_created[path]
+                if f != files_after[path]:
+                    files_updated[path] = files_after[path]
+            self._diff = files_created, files_deleted, files_updated
+        self.timings["diff"] = time.perf_counter() - started
+        if not self.keep_snapshots:
+            self._files_before = self._files_after = None
+        return self._diff
+
+    def assert_no_error(self, quiet: bool) -> None:
+        __tracebackhide__ = True
+        if self.timed_out:
+            if not quiet:
+                print(self)
+            raise AssertionError("Script timed out")
+        if self.returncode != 0:
+            if not quiet:
+                print(self)
+            raise AssertionError("Script returned code: %s" % self.returncode)
+
+    def assert_within_budget(
+        self,
+        budget: Mapping[str, Optional[float]],
+        quiet: bool,
+        enforced: bool = False,
+    ) -> None:
+        """
+        Check the ``"wall"``, ``"cpu"`` (seconds) and ``"rss"`` (bytes)
+        limits in ``budget`` against the metrics of the run; metrics the
+        platform doesn't report are not checked.  If the limits were
+        ``enforced``, a command killed by the CPU limit is over budget
+        even when its rounded CPU time is not.
+        """
+        __tracebackhide__ = True
+        used = dict(self.metrics)
+        if "user_cpu" in used:
+            used["cpu"] = used["user_cpu"] + used["system_cpu"]
+        if "max_rss" in used:
+            used["rss"] = used["max_rss"]
+        over = []
+        for name, limit in budget.items():
+            if limit is None or name not in used or used[name] <= limit:
+                continue
+            if name == "rss":
+                over.append(
+                    "rss %.1fMiB > %.1fMiB"
+                    % (used[name] / (1024 * 1024), limit / (1024 * 1024))
+                )
+            else:
+                over.append("%s %.3fs > %.3fs" % (name, used[name], limit))
+        cpu = budget.get("cpu")
+        if (
+            enforced
+            and cpu is not None
+            and not any(o.startswith("cpu ") for o in over)
+            and self.returncode in _CPU_LIMIT_SIGNALS
+            and not self.timed_out
+        ):
+            over.append("cpu killed at the %.3fs limit" % cpu)
+        if over:
+            if not quiet:
+                print(self)
+            raise AssertionError("Script exceeded its budget: %s" % ", ".join(over))
+
+    def assert_no_stderr(self, quiet: bool) -> None:
+        __tracebackhide__ = True
+        if self.stderr_stream if self._stderr is None else self._stderr:
+            if not quiet:
+                print(self)
+            else:
                 print("Error output:")
                 print(self.stderr)
             raise AssertionError("stderr output not expected")
@@ -463,16 +3177,7 @@ class ProcResult:
         You can use ``*`` to match any portion of a filename, and
         ``**`` to match multiple segments/directories.
         """
-        regex_parts = []
-        for index, part in enumerate(wildcard.split("**")):
-            if index:
-                regex_parts.append(".*")
-            for internal_index, internal_part in enumerate(part.split("*")):
-                if internal_index:
-                    regex_parts.append("[^/\\\\]*")
-                regex_parts.append(re.escape(internal_part))
-        pattern = "".join(regex_parts) + "$"
-        regex = re.compile(pattern)
+        regex = re.compile(_wildcard_regex(wildcard) + "$")
         results = []
         for container in self.files_updated, self.files_created:
             for key, value in sorted(container.items()):
@@ -484,6 +3189,12 @@ class ProcResult:
         s = ["Script result: %s" % " ".join(self.args)]
         if self.returncode:
             s.append("  return code: %s" % self.returncode)
+        if self.timed_out:
+            s.append("  timed out")
+        if self.test_env.report_metrics:
+            self._compare_files()
+            s.append("  metrics: %s" % _format_metrics(self.metrics))
+            s.append("  scripttest: %s" % _format_metrics(self.timings))
         if self.stderr:
             s.append("-- stderr: --------------------")
             s.append(self.stderr)
@@ -523,48 +3234,195 @@ class FoundFile:
         The full path
 
     ``bytes``:
-        The contents of the file.
+        The contents of the file, decoded as UTF-8.
+
+    ``raw``:
+        The contents of the file as a read-only ``memoryview`` over a
+        memory map, so large or binary files are not read into memory.
 
     ``stat``:
         The results of ``os.stat``.  Also ``mtime`` and ``size``
-        contain the ``.st_mtime`` and ``.st_size`` of the stat.
+        contain the ``.st_mtime`` and ``.st_size`` of the stat.  For
+        files taken from a snapshot it is rebuilt from the fields the
+        snapshot keeps (mode, inode, device, size, modification and
+        status change times); the other fields are 0.
 
     ``mtime``:
         The modification time of the file.
 
+    ``mtime_ns``, ``ctime_ns``:
+        The modification and status change times, in nanoseconds.
+
     ``size``:
         The size (in bytes) of the file.
 
+    ``hash``:
+        A hash of the file contents: a CRC32, or a 64-bit BLAKE2b when
+        the file was fingerprinted with ``"blake2b"`` or ``"sampled"``.
+        Unless the file was fingerprinted when the snapshot was taken,
+        this is computed on first access; it is None if the file was
+        changed or deleted since the snapshot and its hash is not known
+        (e.g. the ``files_before`` entry of an updated file).
+
     You may use the ``in`` operator with these objects (tested against
-    the contents of the file), and the ``.mustcontain()`` method.
+    the contents of the file), and the ``.mustcontain()`` method.  Both
+    work on the memory map, as do ``.search()`` and ``.iter_chunks()``.
     """
 
+    __slots__ = (
+        "base_path",
+        "path",
+        "stat",
+        "invalid",
+        "_hash",
+        "_hashed",
+        "_racy",
+        "_by_content",
+        "_algorithm",
+        "_hash_cache",
+        "_bytes",
+    )
+
     file = True
     dir = False
-    invalid = False
 
-    def __init__(self, base_path: str, path: str) -> None:
+    def __init__(
+        self,
+        base_path: str,
+        path: str,
+        fingerprint: str = "auto",
+        snapshot_ns: Optional[int] = None,
+        hash_cache: Optional[_HashCache] = None,
+        st: Optional[os.stat_result] = None,
+    ) -> None:
         self.base_path = base_path
         self.path = path
-        self.full = os.path.join(base_path, path)
-        self.stat: Optional[os.stat_result]
-        self.mtime: Optional[float]
-        self.size: Union[int, str]
-        if os.path.exists(self.full):
-            self.stat = os.stat(self.full)
-            self.mtime = self.stat.st_mtime
-            self.size = self.stat.st_size
-            if stat.S_ISFIFO(os.stat(self.full).st_mode):
-                self.hash = None  # it's a pipe
-            else:
-                with open(self.full, "rb") as fp:
-                    self.hash = zlib.crc32(fp.read())
-        else:
-            self.invalid = True
-            self.stat = self.mtime = None
-            self.size = "N/A"
-            self.hash = None
+        self.stat: Optional[os.stat_result] = None
+        self.invalid = False
+        self._hash: Optional[int] = None
+        self._hashed = False
+        self._racy = False
+        self._by_content = fingerprint not in ("auto", "stat")
+        self._algorithm = _FINGERPRINTS[fingerprint]
+        self._hash_cache = hash_cache
         self._bytes: Optional[str] = None
+        if st is None and os.path.exists(self.full):
+            st = os.stat(self.full)
+        if st is None:
+            self.invalid = True
+            self._hashed = True
+            return
+        self.stat = st
+        if snapshot_ns is not None and fingerprint != "stat":
+            self._racy = _is_racy(st, snapshot_ns)
+        if self._by_content or self._racy:
+            self._hash = self._compute_hash()
+            self._hashed = True
+        elif hash_cache is not None:
+            cached = hash_cache.get(_stat_identity(st) + (self._algorithm,))
+            if cached is not None:
+                self._hash = cached
+                self._hashed = True
+
+    @classmethod
+    def _from_record(
+        cls,
+        base_path: str,
+        path: str,
+        st: Optional[os.stat_result],
+        hash: Optional[int],
+        hashed: bool,
+        racy: bool,
+        by_content: bool,
+        algorithm: str,
+        hash_cache: Optional[_HashCache],
+    ) -> "FoundFile":
+        """Recreate a file from what a snapshot recorded about it."""
+        self = cls.__new__(cls)
+        self.base_path = base_path
+        self.path = path
+        self.stat = st
+        self.invalid = st is None
+        self._hash = hash
+        self._hashed = hashed
+        self._racy = racy
+        self._by_content = by_content
+        self._algorithm = algorithm
+        self._hash_cache = hash_cache
+        self._bytes = None
+        return self
+
+    @property
+    def full(self) -> str:
+        return os.path.join(self.base_path, self.path)
+
+    @property
+    def mtime(self) -> Optional[float]:
+        return self.stat.st_mtime if self.stat is not None else None
+
+    @property
+    def mtime_ns(self) -> Optional[int]:
+        return self.stat.st_mtime_ns if self.stat is not None else None
+
+    @property
+    def ctime_ns(self) -> Optional[int]:
+        return self.stat.st_ctime_ns if self.stat is not None else None
+
+    @property
+    def size(self) -> Union[int, str]:
+        return self.stat.st_size if self.stat is not None else "N/A"
+
+    @property
+    def _key(self) -> Optional[Tuple[int, int, int, int]]:
+        if self.stat is None:
+            return None
+        st = self.stat
+        return (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+    def _compute_hash(self, algorithm: Optional[str] = None) -> Optional[int]:
+        """
+        Hash the contents ``stat`` was recorded for, or return None if the
+        file has changed or gone away since.
+        """
+        assert self.stat is not None
+        if stat.S_ISFIFO(self.stat.st_mode):
+            return None  # it's a pipe
+        algorithm = algorithm or self._algorithm
+        key = _stat_identity(self.stat) + (algorithm,)
+        if self._hash_cache is not None and not self._racy:
+            cached = self._hash_cache.get(key)
+            if cached is not None:
+                return cached
+        try:
+            fp = open(self.full, "rb")
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        with fp:
+            st = os.fstat(fp.fileno())
+            if (st.st_size, st.st_mtime_ns, st.st_ctime_ns, _fold64(st.st_ino)) != (
+                self.stat.st_size,
+                self.stat.st_mtime_ns,
+                self.stat.st_ctime_ns,
+                _fold64(self.stat.st_ino),
+            ):
+                # Whatever is there now, it isn't what this entry describes
+                return None
+            value = _hash_file(fp, algorithm)
+            # Only cache the hash if the file still is what was recorded
+            if (
+                self._hash_cache is not None
+                and not self._racy
+                and _stat_identity(os.fstat(fp.fileno())) + (algorithm,) == key
+            ):
+                self._hash_cache.put(key, value)
+        return value
+
+    @property
+    def hash(self) -> Optional[int]:
+        if not self._hashed:
+            self._hash = self._compute_hash()
+            self._hashed = True
+        return self._hash
 
     def bytes__get(self) -> str:
         if self._bytes is None:
@@ -575,16 +3433,42 @@ class FoundFile:
 
     bytes = property(bytes__get)
 
-    def __contains__(self, s: str) -> bool:
-        return s in self.bytes
+    def _map(self) -> _Buffer:
+        with open(self.full, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b""
+            # The mapping stays open as long as something refers to it
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def raw(self) -> memoryview:
+        return memoryview(self._map())
+
+    def iter_chunks(self, size: int = 65536) -> Iterator[builtins.bytes]:
+        """The contents of the file in pieces of at most ``size`` bytes."""
+        with open(self.full, "rb") as f:
+            for chunk in iter(lambda: f.read(size), b""):
+                yield chunk
+
+    def search(self, pattern: _SearchPattern) -> Optional[Match[builtins.bytes]]:
+        """
+        Search the contents for ``pattern``: a string or bytes to find
+        literally, or a compiled bytes regular expression.
+        """
+        return _search_pattern(pattern).search(self._map())
+
+    def __contains__(self, s: _SearchPattern) -> bool:
+        return self.search(s) is not None
 
-    def mustcontain(self, s: str) -> None:
+    def mustcontain(self, s: _SearchPattern) -> None:
         __tracebackhide__ = True
-        bytes = self.bytes
-        if s not in bytes:
+        if s not in self:
+            contents = self._map()
             print("Could not find %r in:" % s)
-            print(bytes)
-            assert s in bytes
+            print(contents[:65536].decode("utf-8", "replace"))
+            if len(contents) > 65536:
+                print("... (%s bytes in all)" % len(contents))
+            raise AssertionError("%r not found in %s" % (s, self.path))
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} {self.base_path}:{self.path}>"
@@ -593,29 +3477,66 @@ class FoundFile:
         if not isinstance(other, FoundFile):
             return NotImplemented
 
-        return (
-            self.hash == other.hash  # noqa: W504
-            and self.mtime == other.mtime  # noqa: W504
-            and self.size == other.size
-        )
+        if self._key != other._key:
+            return False
+        # Identical stat data is only ambiguous when either side was
+        # recorded close enough to a write to share its timestamp tick,
+        # unless the contents were asked to be compared anyway.
+        if self._compare_content or other._compare_content:
+            if self._algorithm == other._algorithm:
+                return self.hash == other.hash
+            return self.hash == other._compute_hash(self._algorithm)
+        return True
+
+    @property
+    def _compare_content(self) -> bool:
+        return self._racy or self._by_content
+
+    def _fingerprint(self) -> Tuple[Any, ...]:
+        # Equal fingerprints imply equal files; the reverse need not hold.
+        # Must agree with _Snapshot._fingerprint.
+        if self._compare_content:
+            return ("f", self._key, True, self._hash, self._algorithm)
+        return ("f", self._key, False, None, None)
 
 
 class FoundDir:
     """
     Represents a directory created by a command.
+
+    Has the same ``path``, ``full``, ``stat``, ``mtime``, ``mtime_ns``
+    and ``ctime_ns`` attributes as ``FoundFile``.
     """
 
+    __slots__ = ("base_path", "path", "stat")
+
     file = False
     dir = True
     invalid = False
+    size = "N/A"
 
-    def __init__(self, base_path: str, path: str) -> None:
+    def __init__(
+        self, base_path: str, path: str, st: Optional[os.stat_result] = None
+    ) -> None:
         self.base_path = base_path
         self.path = path
-        self.full = os.path.join(base_path, path)
-        self.stat = os.stat(self.full)
-        self.size = "N/A"
-        self.mtime = self.stat.st_mtime
+        self.stat = st if st is not None else os.stat(self.full)
+
+    @property
+    def full(self) -> str:
+        return os.path.join(self.base_path, self.path)
+
+    @property
+    def mtime(self) -> float:
+        return self.stat.st_mtime
+
+    @property
+    def mtime_ns(self) -> int:
+        return self.stat.st_mtime_ns
+
+    @property
+    def ctime_ns(self) -> int:
+        return self.stat.st_ctime_ns
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} {self.base_path}:{self.path}>"
@@ -624,7 +3545,644 @@ class FoundDir:
         if not isinstance(other, FoundDir):
             return NotImplemented
 
-        return self.mtime == other.mtime
+        return self._fingerprint() == other._fingerprint()
+
+    def _fingerprint(self) -> Tuple[Any, ...]:
+        return ("d", self.mtime_ns, self.ctime_ns, self.stat.st_ino)
+
+
+class _FoundFiles(Mapping[str, FoundFile]):
+    """Files written at once, by path; looked at only when used."""
+
+    def __init__(self, base_path: str, paths: Iterable[str]) -> None:
+        self.base_path = base_path
+        self.paths = dict.fromkeys(paths)
+
+    def __getitem__(self, path: str) -> FoundFile:
+        if path not in self.paths:
+            raise KeyError(path)
+        return FoundFile(self.base_path, path)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+class _Snapshot(MutableMapping[str, Union[FoundDir, FoundFile]]):
+    """
+    The files found in an environment, by path, arranged as a tree where
+    each directory carries a digest of everything below it.  Comparing
+    two snapshots only descends into directories whose digests differ.
+
+    To keep memory down on big trees, entries are not kept as objects:
+    the stat fields and hashes live in parallel arrays, and ``FoundFile``
+    and ``FoundDir`` objects are recreated when an entry is looked up.
+    """
+
+    # Flags for each entry
+    _DIR = 1
+    _INVALID = 2
+    _HASHED = 4
+    _RACY = 8
+    _NO_HASH = 16
+    _BY_CONTENT = 32
+    # The hash function, as an index into _HASH_ALGORITHMS
+    _ALGORITHM_SHIFT = 6
+
+    _COLUMNS = (
+        ("_mode", "I"),
+        ("_ino", "Q"),
+        ("_size", "q"),
+        ("_mtime_ns", "q"),
+        ("_ctime_ns", "q"),
+        ("_hash", "Q"),
+    )
+    _mode: "array[int]"
+    _ino: "array[int]"
+    _size: "array[int]"
+    _mtime_ns: "array[int]"
+    _ctime_ns: "array[int]"
+    _hash: "array[int]"
+
+    def __init__(
+        self, base_path: str = "", hash_cache: Optional[_HashCache] = None
+    ) -> None:
+        self.base_path = base_path
+        self.hash_cache = hash_cache
+        # Directory path ("" for the top) to the paths directly in it
+        self.children: Dict[str, List[str]] = {}
+        self.digests: Dict[str, bytes] = {}
+        # Path to the position of its entry in the arrays
+        self._index: Dict[str, int] = {}
+        self._flags = bytearray()
+        for name, typecode in self._COLUMNS:
+            setattr(self, name, array(typecode))
+        # Nearly everything lives on one device; only the exceptions are
+        # stored per entry
+        self._dev = 0
+        self._other_devs: Dict[int, int] = {}
+        # Paths whose entries are compared by content
+        self.compared: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __contains__(self, path: object) -> bool:
+        return path in self._index
+
+    def __getitem__(self, path: str) -> Union[FoundDir, FoundFile]:
+        i = self._index[path]
+        flags = self._flags[i]
+        if flags & self._INVALID:
+            st = None
+        else:
+            # Fields that are not recorded (nlink, uid, gid and atime) are 0
+            mtime_ns = self._mtime_ns[i]
+            ctime_ns = self._ctime_ns[i]
+            st = os.stat_result(
+                (
+                    self._mode[i],
+                    self._ino[i],
+                    self._other_devs.get(i, self._dev),
+                    0,
+                    0,
+                    0,
+                    self._size[i],
+                    0,
+                    mtime_ns // 1000000000,
+                    ctime_ns // 1000000000,
+                ),
+                {
+                    "st_atime": 0.0,
+                    "st_mtime": _ns_to_float(mtime_ns),
+                    "st_ctime": _ns_to_float(ctime_ns),
+                    "st_atime_ns": 0,
+                    "st_mtime_ns": mtime_ns,
+                    "st_ctime_ns": ctime_ns,
+                },
+            )
+        if flags & self._DIR:
+            assert st is not None
+            return FoundDir(self.base_path, path, st=st)
+        hashed = bool(flags & self._HASHED)
+        return FoundFile._from_record(
+            self.base_path,
+            path,
+            st,
+            self._hash[i] if hashed and not flags & self._NO_HASH else None,
+            hashed,
+            bool(flags & self._RACY),
+            bool(flags & self._BY_CONTENT),
+            _HASH_ALGORITHMS[flags >> self._ALGORITHM_SHIFT],
+            self.hash_cache,
+        )
+
+    def __setitem__(self, path: str, f: Union[FoundDir, FoundFile]) -> None:
+        flags = 0
+        hash = 0
+        if isinstance(f, FoundDir):
+            flags |= self._DIR
+        elif f._hashed:
+            flags |= self._HASHED
+            if f._hash is None:
+                flags |= self._NO_HASH
+            else:
+                hash = f._hash
+        if isinstance(f, FoundFile):
+            flags |= _HASH_ALGORITHMS.index(f._algorithm) << self._ALGORITHM_SHIFT
+            if f._racy:
+                flags |= self._RACY
+            if f._by_content:
+                flags |= self._BY_CONTENT
+            if f._compare_content:
+                self.compared.append(path)
+        st = f.stat
+        dev = self._dev
+        if st is None:
+            flags |= self._INVALID
+            values: Tuple[int, ...] = (0,) * 5 + (hash,)
+        else:
+            values = (
+                st.st_mode,
+                _fold64(st.st_ino),
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_ctime_ns,
+                hash,
+            )
+            dev = st.st_dev
+            if not self._index:
+                self._dev = dev
+        i = self._index.get(path)
+        if i is None:
+            i = len(self._flags)
+            self._index[path] = i
+            self._flags.append(flags)
+            for (name, _), value in zip(self._COLUMNS, values):
+                getattr(self, name).append(value)
+        else:
+            self._flags[i] = flags
+            for (name, _), value in zip(self._COLUMNS, values):
+                getattr(self, name)[i] = value
+        if dev != self._dev:
+            self._other_devs[i] = dev
+        else:
+            self._other_devs.pop(i, None)
+
+    def __delitem__(self, path: str) -> None:
+        # The arrays keep the entry until the snapshot is copied
+        del self._index[path]
+
+    def _fingerprint(self, i: int) -> Tuple[Any, ...]:
+        """The fingerprint of the entry at ``i``; see ``FoundFile``."""
+        flags = self._flags[i]
+        ino = self._ino[i]
+        if flags & self._DIR:
+            return ("d", self._mtime_ns[i], self._ctime_ns[i], ino)
+        if flags & self._INVALID:
+            key = None
+        else:
+            key = (self._size[i], self._mtime_ns[i], self._ctime_ns[i], ino)
+        if not flags & (self._RACY | self._BY_CONTENT):
+            return ("f", key, False, None, None)
+        hash = None if flags & self._NO_HASH else self._hash[i]
+        algorithm = _HASH_ALGORITHMS[flags >> self._ALGORITHM_SHIFT]
+        return ("f", key, True, hash, algorithm)
+
+    def dir_mtimes(self) -> Iterator[Tuple[str, int]]:
+        """The full path and ``st_mtime_ns`` of every directory."""
+        for path, i in self._index.items():
+            if self._flags[i] & self._DIR:
+                yield os.path.join(self.base_path, path), self._mtime_ns[i]
+
+    def add_scanned(
+        self,
+        dirpath: str,
+        children: List[str],
+        found: List[Union[FoundDir, FoundFile]],
+        subdirs: List[Tuple[str, str]],
+    ) -> List[Tuple[str, str]]:
+        """
+        Add the results of scanning one directory, returning the
+        subdirectories still to scan.
+        """
+        self.children[dirpath] = children
+        for f in found:
+            self[f.path] = f
+        for path, _ in subdirs:
+            self.children[path] = []
+        return subdirs
+
+    def copy(self) -> "_Snapshot":
+        new = _Snapshot(self.base_path, self.hash_cache)
+        new.children = self.children.copy()
+        new.digests = self.digests.copy()
+        new._dev = self._dev
+        new.compared = self.compared[:]
+        if len(self._flags) > 2 * len(self._index):
+            # Leave out the entries that were removed
+            keep = list(self._index.values())
+            new._index = dict(zip(self._index, range(len(keep))))
+            new._flags = bytearray(self._flags[i] for i in keep)
+            for name, typecode in self._COLUMNS:
+                column = getattr(self, name)
+                setattr(new, name, array(typecode, [column[i] for i in keep]))
+            new._other_devs = {
+                new_i: self._other_devs[i]
+                for new_i, i in enumerate(keep)
+                if i in self._other_devs
+            }
+        else:
+            new._index = self._index.copy()
+            new._flags = self._flags[:]
+            for name, _ in self._COLUMNS:
+                setattr(new, name, getattr(self, name)[:])
+            new._other_devs = self._other_devs.copy()
+        return new
+
+    def settle(self, before: "_Snapshot") -> None:
+        """
+        Hash the files that are compared by content in ``before`` and
+        look unchanged here.  Comparing them needs their content as it is
+        now, not as it is whenever the comparison happens to be made.
+        """
+        settled = False
+        for path in before.compared:
+            i = self._index.get(path)
+            if i is None or self._flags[i] & (self._DIR | self._HASHED):
+                continue
+            f = self[path]
+            assert isinstance(f, FoundFile)
+            other = before.get(path)
+            if isinstance(other, FoundFile) and other._key == f._key:
+                # Compared by content like the other side, so both get the
+                # same fingerprint if the contents are the same
+                f._algorithm = other._algorithm
+                f._by_content = True
+                f.hash
+                self[path] = f
+                self.invalidate(os.path.dirname(path))
+                settled = True
+        if settled:
+            self.seal()
+
+    def remove(self, path: str) -> None:
+        """Remove ``path`` and everything below it."""
+        self._index.pop(path, None)
+        self.digests.pop(path, None)
+        for child in self.children.pop(path, ()):
+            self.remove(child)
+
+    def invalidate(self, dirpath: str) -> None:
+        """Forget the digests of ``dirpath`` and the directories above it."""
+        while True:
+            self.digests.pop(dirpath, None)
+            if not dirpath:
+                break
+            dirpath = os.path.dirname(dirpath)
+
+    def seal(self) -> None:
+        """Compute the digests that are missing, once all entries are added."""
+        missing = [path for path in self.children if path not in self.digests]
+        for dirpath in sorted(missing, key=_path_depth, reverse=True):
+            h = hashlib.blake2b(digest_size=16)
+            for path in sorted(self.children[dirpath]):
+                i = self._index.get(path)
+                entry = (
+                    os.path.basename(path),
+                    self._fingerprint(i) if i is not None else None,
+                    self.digests.get(path),
+                )
+                h.update(repr(entry).encode("utf-8"))
+            self.digests[dirpath] = h.digest()
+
+    def diff(self, after: "_Snapshot") -> Tuple[
+        Dict[str, Union[FoundDir, FoundFile]],
+        Dict[str, Union[FoundDir, FoundFile]],
+        Dict[str, Union[FoundDir, FoundFile]],
+    ]:
+        """
+        Return the files created, deleted and updated going from this
+        snapshot to ``after``.
+        """
+        created: Dict[str, Union[FoundDir, FoundFile]] = {}
+        deleted: Dict[str, Union[FoundDir, FoundFile]] = {}
+        updated: Dict[str, Union[FoundDir, FoundFile]] = {}
+        pending = [""]
+        while pending:
+            dirpath = pending.pop()
+            digest = self.digests.get(dirpath)
+            if digest is not None and digest == after.digests.get(dirpath):
+                continue
+            before_children = self.children.get(dirpath, [])
+            after_children = after.children.get(dirpath, [])
+            before_set = set(before_children)
+            for path in after_children:
+                if path not in before_set:
+                    after._collect(path, created)
+            after_set = set(after_children)
+            for path in before_children:
+                if path not in after_set:
+                    self._collect(path, deleted)
+                    continue
+                f_before = self.get(path)
+                f_after = after.get(path)
+                if f_before is not None and f_after is not None:
+                    if f_before != f_after:
+                        updated[path] = f_after
+                if path in self.children or path in after.children:
+                    pending.append(path)
+        return created, deleted, updated
+
+    def _collect(self, path: str, into: Dict[str, Union[FoundDir, FoundFile]]) -> None:
+        """Add ``path`` and everything below it to ``into``."""
+        f = self.get(path)
+        if f is not None:
+            into[path] = f
+        for child in self.children.get(path, ()):
+            self._collect(child, into)
+
+
+def _watch_roots(paths: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    """
+    Normalize watched paths, dropping those inside other watched paths.
+    ``None`` means the whole environment is watched.
+    """
+    if paths is None:
+        return None
+    roots: List[str] = []
+    for path in sorted(os.path.normpath(p) for p in paths):
+        if path in (os.curdir, ""):
+            return None
+        if (
+            path == os.pardir
+            or path.startswith(os.pardir + os.sep)
+            or os.path.isabs(path)
+        ):
+            raise ValueError("Watched path %r is not inside base_path" % path)
+        if not any(path.startswith(root + os.sep) for root in roots):
+            roots.append(path)
+    return tuple(roots)
+
+
+def _wildcard_regex(wildcard: str) -> str:
+    """
+    Translate a wildcard, where ``*`` matches within one path segment and
+    ``**`` across segments, to a regular expression.
+    """
+    regex_parts = []
+    for index, part in enumerate(wildcard.split("**")):
+        if index:
+            regex_parts.append(".*")
+        for internal_index, internal_part in enumerate(part.split("*")):
+            if internal_index:
+                regex_parts.append("[^/\\\\]*")
+            regex_parts.append(re.escape(internal_part))
+    return "".join(regex_parts)
+
+
+_INLINE_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"))
+
+
+def _rule_regex(rule: Union[str, Pattern[str]]) -> str:
+    """
+    Translate a path rule (a path, a wildcard or a compiled regular
+    expression) to a regular expression for ``/``-separated paths.  A
+    trailing ``/`` is dropped.
+    """
+    if not isinstance(rule, str):
+        flags = "".join(c for flag, c in _INLINE_FLAGS if rule.flags & flag)
+        if flags:
+            return "(?%s:%s)" % (flags, rule.pattern)
+        return "(?:%s)" % rule.pattern
+    rule = rule.replace(os.sep, "/").rstrip("/")
+    if "*" not in rule:
+        return re.escape(rule)
+    if "/" in rule:
+        return _wildcard_regex(rule)
+    return "(?:.*/)?" + _wildcard_regex(rule)
+
+
+def _compile_ignore_rules(
+    rules: Iterable[Union[str, Pattern[str]]], ignore_hidden: bool
+) -> Tuple[Pattern[str], Pattern[str]]:
+    """
+    Compile ignore rules into a matcher for any path and a matcher for
+    directories only; both are matched against ``/``-separated paths.
+    """
+    any_parts = [re.escape(_HASH_CACHE_FILE)]
+    dir_parts: List[str] = []
+    if ignore_hidden:
+        any_parts.append(r"(?:.*/)?\.[^/]*")
+    for rule in rules:
+        if isinstance(rule, str) and rule.replace(os.sep, "/").endswith("/"):
+            dir_parts.append(_rule_regex(rule))
+        else:
+            any_parts.append(_rule_regex(rule))
+    dir_parts.extend(any_parts)
+    return (
+        re.compile("(?:%s)$" % "|".join(any_parts)),
+        re.compile("(?:%s)$" % "|".join(dir_parts)),
+    )
+
+
+def _decode_output(output: bytes) -> str:
+    text = string(output).replace("\r\n", "\n")
+    if sys.platform == "win32":
+        text = text.replace("\n\r", "\n")
+    return text
+
+
+def _decode_line(line: bytes) -> str:
+    if line.endswith(b"\r"):
+        line = line[:-1]
+    return string(line)
+
+
+def _ns_to_float(ns: int) -> float:
+    # Rounds the way os.stat() does
+    return ns // 1000000000 + ns % 1000000000 * 1e-9
+
+
+def _fold64(value: int) -> int:
+    """Fit identifiers wider than 64 bits, like some Windows inodes."""
+    while value >> 64:
+        value = (value & 0xFFFFFFFFFFFFFFFF) ^ (value >> 64)
+    return value
+
+
+def _clear_later(path: str) -> None:
+    """
+    Move the directory ``path`` out of the way, to be deleted by
+    ``_reaper``, along with what earlier sessions left behind.
+    """
+    # The reaper may get to it after the working directory changed
+    path = os.path.abspath(path)
+    for tombstone in glob.glob(glob.escape(path) + _TOMBSTONE_SUFFIX + "*"):
+        _reaper.add(tombstone)
+    tombstone = "%s%s%d-%d" % (
+        path,
+        _TOMBSTONE_SUFFIX,
+        os.getpid(),
+        next(_tombstone_counter),
+    )
+    try:
+        os.rename(path, tombstone)
+    except OSError:
+        # e.g. a mount point, or a directory in use on Windows
+        shutil.rmtree(path, onerror=onerror)
+    else:
+        _reaper.add(tombstone)
+
+
+class _Reaper:
+    """
+    Deletes the directories ``clear()`` moved out of the way, on a thread
+    of its own, and whatever is left when the interpreter exits.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pending: List[str] = []
+        self.thread: Optional[threading.Thread] = None
+        self.registered = False
+
+    def add(self, path: str) -> None:
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending.append(path)
+            if not self.registered:
+                atexit.register(self.finish)
+                self.registered = True
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="scripttest-reaper", daemon=True
+                )
+                self.thread.start()
+
+    def run(self) -> None:
+        while self.reap():
+            pass
+
+    def reap(self) -> bool:
+        """Delete one pending directory; False if there are none."""
+        with self.lock:
+            if not self.pending:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                return False
+            path = self.pending.pop()
+        try:
+            shutil.rmtree(path, onerror=onerror)
+        except OSError:
+            pass  # swept again by the next clear()
+        return True
+
+    def finish(self) -> None:
+        """Delete all pending directories, and wait for the thread."""
+        while self.reap():
+            pass
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+# Added to base_path to name the directories waiting to be deleted
+_TOMBSTONE_SUFFIX = ".scripttest-trash-"
+_tombstone_counter = itertools.count()
+_reaper = _Reaper()
+
+
+def _archive_path(path: str, name: str) -> str:
+    """Where the archive member ``name`` goes, when written under ``path``."""
+    parts = [
+        part for part in name.replace("\\", "/").split("/") if part not in ("", ".")
+    ]
+    if ".." in parts or os.path.isabs(name):
+        raise ValueError("%s in the archive would be written outside %r" % (name, path))
+    return os.path.join(path, *parts)
+
+
+def _copy_file(src: str, dest: str, mode: str = "auto") -> bool:
+    """
+    Copy the contents of ``src`` to ``dest`` the cheapest way ``mode``
+    (see ``copytree_from_template()``) allows: a hard link, a reflink,
+    ``copy_file_range()``, ``sendfile()`` and finally plain reads and
+    writes.  Returns whether ``dest`` is a hard link to ``src``.
+    """
+    if os.path.lexists(dest):
+        # It may be a hard link to the template: writing through it would
+        # overwrite the template itself
+        os.unlink(dest)
+    if mode == "hardlink":
+        try:
+            os.link(src, dest)
+            return True
+        except FileExistsError:
+            raise
+        except OSError:
+            pass  # e.g. on another filesystem
+    if mode != "copy":
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+            if _clone_file(fsrc.fileno(), fdst.fileno()):
+                return False
+            if _copy_file_range(fsrc.fileno(), fdst.fileno()):
+                return False
+    # Uses sendfile() where the platform has it
+    shutil.copyfile(src, dest)
+    return False
+
+
+def _clone_file(src_fd: int, dest_fd: int) -> bool:
+    """Make ``dest_fd`` share the storage of ``src_fd``, if possible."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+    except OSError:
+        return False  # not supported by the filesystem
+    return True
+
+
+def _copy_file_range(src_fd: int, dest_fd: int) -> bool:
+    """Copy ``src_fd`` to ``dest_fd`` in the kernel, if possible."""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    size = os.fstat(src_fd).st_size
+    copied = 0
+    while copied < size:
+        try:
+            n = os.copy_file_range(src_fd, dest_fd, size - copied)
+        except OSError:
+            if copied:
+                raise
+            return False  # e.g. across filesystems on older kernels
+        if not n:
+            break  # the file shrank
+        copied += n
+    return True
+
+
+def _path_depth(path: str) -> int:
+    return path.count(os.sep) if path else -1
+
+
+def _is_racy(st: os.stat_result, snapshot_ns: int) -> bool:
+    """
+    Whether a file with the stat ``st`` could still be modified without
+    its stat changing, as seen from a snapshot taken at ``snapshot_ns``.
+    """
+    if st.st_mtime_ns % 1000000000:
+        window = _RACY_NS
+    else:
+        window = _RACY_COARSE_NS
+    return max(st.st_mtime_ns, st.st_ctime_ns) >= snapshot_ns - window
 
 
 def _space_prefix(
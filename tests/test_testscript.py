@@ -1,5 +1,6 @@
 import os
 import sys
+import re
 import time
 from scripttest import TestFileEnvironment
 
@@ -7,6 +8,19 @@ here = os.path.dirname(__file__)
 script = os.path.join(here, "a_script.py")
 
 
+def _overlapped(results):
+    """
+    Whether any two of the runs, which print their start and end times,
+    were running at the same time.
+    """
+    spans = [tuple(map(float, result.stdout.split())) for result in results]
+    return any(
+        start < other_end and other_start < end
+        for index, (start, end) in enumerate(spans)
+        for other_start, other_end in spans[index + 1 :]
+    )
+
+
 def test_testscript(tmpdir):
     env = TestFileEnvironment(str(tmpdir), start_clear=False)
     res = env.run(sys.executable, script, "test-file.txt")
@@ -31,8 +45,6 @@ def test_testscript(tmpdir):
         pass
     else:
         assert 0
-    # because modification time is in seconds and the tests are too fast
-    time.sleep(1)
     res = env.run(sys.executable, script, "test-file.txt")
     assert not res.files_created
     assert "test-file.txt" in res.files_updated, res.files_updated
@@ -73,3 +85,897 @@ os.symlink(os.path.join('does', 'not', 'exist.txt'), "does-not-exist.txt")
     assert res.files_created["does-not-exist.txt"].invalid
     # Just make sure there's no error:
     str(res)
+
+
+def test_fingerprint_stat_first(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    for name in ["old.txt", "edited.txt", "gone.txt"]:
+        env.writefile(name, b"old")
+    # move the files out of the window where a rewrite could hide in the
+    # same timestamp tick
+    time.sleep(0.2)
+    env.writefile("new.txt", b"new")
+    files = env._find_files()
+    assert not files["old.txt"]._hashed
+    assert files["new.txt"]._hashed
+    assert files["old.txt"].hash is not None
+    res = env.run(
+        sys.executable,
+        "-c",
+        "open('new.txt', 'wb').write(b'NEW')",
+    )
+    assert list(res.files_updated) == ["new.txt"], res.files_updated
+    res = env.run(
+        sys.executable,
+        "-c",
+        "import os; open('edited.txt', 'wb').write(b'edit'); os.remove('gone.txt')",
+    )
+    # Never hashed, and no longer there to be hashed as they were
+    assert res.files_deleted["gone.txt"].hash is None
+    assert res.files_before["edited.txt"].hash is None
+    assert res.files_after["edited.txt"].hash is not None
+
+
+def test_bad_fingerprint(tmpdir):
+    try:
+        TestFileEnvironment(str(tmpdir), start_clear=False, fingerprint="md5")
+    except ValueError:
+        pass
+    else:
+        assert 0
+
+
+def test_persistent_hash_cache(tmpdir):
+    env = TestFileEnvironment(
+        str(tmpdir), start_clear=False, fingerprint="content", persist_hash_cache=True
+    )
+    env.writefile("a.txt", b"a")
+    env.writefile("b.txt", b"b")
+    time.sleep(0.2)
+    env.run(sys.executable, "-c", "pass")
+    assert len(env.hash_cache) == 2
+    assert os.path.exists(os.path.join(str(tmpdir), ".scripttest-hash-cache.json"))
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, persist_hash_cache=True)
+    assert len(env.hash_cache) == 2
+    files = env._find_files()
+    assert sorted(files) == ["a.txt", "b.txt"]
+    assert files["a.txt"]._hashed
+
+
+def test_chain_snapshots(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, chain_snapshots=True)
+    res1 = env.run(sys.executable, script, "a.txt")
+    res2 = env.run(sys.executable, script, "b.txt")
+    assert res2.files_before is res1.files_after
+    assert list(res2.files_created) == ["b.txt"]
+    env.writefile("c.txt", b"c")
+    res3 = env.run(sys.executable, "-c", "pass")
+    assert res3.files_before is not res2.files_after
+    assert "c.txt" in res3.files_before
+    # a change behind scripttest's back that touches a directory is noticed
+    os.mkdir(os.path.join(str(tmpdir), "sub"))
+    res4 = env.run(sys.executable, "-c", "pass")
+    assert res4.files_before is not res3.files_after
+    assert not res4.files_created
+
+
+def test_snapshot_diff_matches_full_comparison(tmpdir):
+    from scripttest import ProcResult
+
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    for path in ["a/b/c.txt", "a/b/d.txt", "a/e.txt", "f/g.txt", "h/i/j.txt"]:
+        env.writefile(path, b"x")
+    res = env.run(
+        sys.executable,
+        "-c",
+        """\
+import os, shutil
+open(os.path.join('a', 'b', 'c.txt'), 'w').write('changed')
+shutil.rmtree('f')
+os.makedirs(os.path.join('k', 'l'))
+open(os.path.join('k', 'l', 'm.txt'), 'w').write('new')
+""",
+    )
+    assert res.files_before.digests["h"] == res.files_after.digests["h"]
+    assert res.files_before.digests[""] != res.files_after.digests[""]
+    full = ProcResult(
+        env,
+        res.args,
+        b"",
+        "",
+        "",
+        0,
+        dict(res.files_before),
+        dict(res.files_after),
+    )
+    assert sorted(res.files_created) == sorted(full.files_created)
+    assert sorted(res.files_deleted) == sorted(full.files_deleted)
+    assert sorted(res.files_updated) == sorted(full.files_updated)
+    assert os.path.join("k", "l", "m.txt") in res.files_created
+    assert os.path.join("f", "g.txt") in res.files_deleted
+    assert os.path.join("a", "b", "c.txt") in res.files_updated
+
+
+def test_ignore_rules(tmpdir):
+    import re
+
+    env = TestFileEnvironment(
+        str(tmpdir),
+        start_clear=False,
+        ignore_paths=[
+            "node_modules/",
+            "*.pyc",
+            "exact.txt",
+            re.compile(r"LOGS/.*", re.I),
+        ],
+    )
+    for path in [
+        "node_modules/pkg/index.js",
+        "src/node_modules",
+        "src/mod.pyc",
+        "src/mod.py",
+        "exact.txt",
+        "src/exact.txt",
+        "logs/run.log",
+    ]:
+        env.writefile(path, b"")
+    files = env._find_files()
+    assert sorted(files) == sorted(
+        [
+            "src",
+            os.path.join("src", "node_modules"),
+            os.path.join("src", "mod.py"),
+            os.path.join("src", "exact.txt"),
+            "logs",
+        ]
+    )
+    assert "node_modules" not in files.children
+
+
+def test_parallel_snapshot(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, snapshot_workers=4)
+    for index in range(50):
+        env.writefile(os.path.join("d%d" % (index % 7), "f%d.txt" % index), b"x")
+    parallel = env._find_files()
+    env.snapshot_workers = 1
+    sequential = env._find_files()
+    assert sorted(parallel) == sorted(sequential)
+    assert sorted(parallel.children) == sorted(sequential.children)
+    res = env.run(sys.executable, script, os.path.join("d1", "new.txt"))
+    assert list(res.files_created) == [os.path.join("d1", "new.txt")]
+
+
+def test_watch_paths(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, watch_paths=["out"])
+    res = env.run(sys.executable, script, "outside.txt")
+    assert not res.files_created
+    res = env.run(sys.executable, "-c", "import os; os.mkdir('out')")
+    assert list(res.files_created) == ["out"]
+    res = env.run(sys.executable, script, os.path.join("out", "a.txt"), "b.txt")
+    assert list(res.files_created) == [os.path.join("out", "a.txt")]
+    res = env.run(sys.executable, script, "c.txt", watch=["c.txt", "out"])
+    assert list(res.files_created) == ["c.txt"]
+    res = env.run(sys.executable, script, "d.txt", watch=[os.curdir])
+    assert list(res.files_created) == ["d.txt"]
+    res = env.run(sys.executable, script, "e.txt", watch=None, snapshot=False)
+    assert not res.files_created
+    assert not res.files_before
+
+
+def test_inotify_change_tracking(tmpdir):
+    if not sys.platform.startswith("linux"):
+        return
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, change_tracking="inotify")
+    for path in [
+        "keep/a.txt",
+        "mod/b.txt",
+        "gone/c/d.txt",
+        "moved/e.txt",
+        "f",
+        "redo/old.txt",
+    ]:
+        env.writefile(path, b"x")
+    os.makedirs(os.path.join(env.base_path, "empty"))
+    os.makedirs(os.path.join(env.base_path, "redo", "sub"))
+    res = env.run(
+        sys.executable,
+        "-c",
+        """\
+import os, shutil
+open(os.path.join('mod', 'b.txt'), 'w').write('changed')
+shutil.rmtree('gone')
+os.rename('moved', 'renamed')
+os.remove('f')
+os.makedirs(os.path.join('f', 'g'))
+open(os.path.join('f', 'g', 'h.txt'), 'w').write('new')
+os.rmdir('empty')
+os.mkdir('empty')
+open(os.path.join('empty', 'new.txt'), 'w').write('new')
+os.rmdir(os.path.join('redo', 'sub'))
+os.mkdir(os.path.join('redo', 'sub'))
+open(os.path.join('redo', 'sub', 'new.txt'), 'w').write('new')
+""",
+    )
+    assert res.files_after.digests  # sealed
+    walked = env._find_files()
+    assert sorted(res.files_after) == sorted(walked)
+    assert {k: sorted(v) for k, v in res.files_after.children.items()} == {
+        k: sorted(v) for k, v in walked.children.items()
+    }
+    assert sorted(res.files_created) == sorted(
+        [
+            "renamed",
+            os.path.join("renamed", "e.txt"),
+            os.path.join("f", "g"),
+            os.path.join("f", "g", "h.txt"),
+            os.path.join("empty", "new.txt"),
+            os.path.join("redo", "sub", "new.txt"),
+        ]
+    )
+    assert sorted(res.files_deleted) == sorted(
+        [
+            "gone",
+            os.path.join("gone", "c"),
+            os.path.join("gone", "c", "d.txt"),
+            "moved",
+            os.path.join("moved", "e.txt"),
+        ]
+    )
+    assert os.path.join("mod", "b.txt") in res.files_updated
+    assert "f" in res.files_updated
+    assert res.files_after["f"].dir
+
+
+def test_update_without_sleep(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    write = "open('same-size.txt', 'wb').write(%r)"
+    res = env.run(sys.executable, "-c", write % b"one")
+    assert list(res.files_created) == ["same-size.txt"]
+    for content in [b"two", b"six"]:
+        res = env.run(sys.executable, "-c", write % content)
+        assert list(res.files_updated) == ["same-size.txt"]
+    # timestamps put back as they were are still caught
+    res = env.run(
+        sys.executable,
+        "-c",
+        """\
+import os
+st = os.stat('same-size.txt')
+open('same-size.txt', 'wb').write(b'ten')
+os.utime('same-size.txt', ns=(st.st_atime_ns, st.st_mtime_ns))
+""",
+    )
+    assert list(res.files_updated) == ["same-size.txt"]
+    f = res.files_updated["same-size.txt"]
+    assert f.mtime_ns == res.files_before["same-size.txt"].mtime_ns
+    assert f.ctime_ns != res.files_before["same-size.txt"].ctime_ns
+
+
+def test_compact_snapshot(tmpdir):
+    from scripttest import FoundDir, FoundFile
+
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    env.writefile(os.path.join("sub", "a.txt"), b"contents")
+    files = env._find_files()
+    f = files[os.path.join("sub", "a.txt")]
+    direct = FoundFile(str(tmpdir), os.path.join("sub", "a.txt"))
+    assert not hasattr(f, "__dict__")
+    assert f == direct
+    assert f.full == direct.full
+    assert (f.size, f.mtime, f.mtime_ns, f.ctime_ns) == (
+        direct.size,
+        direct.mtime,
+        direct.mtime_ns,
+        direct.ctime_ns,
+    )
+    assert f.stat.st_mode == direct.stat.st_mode
+    assert f.stat.st_ino == direct.stat.st_ino
+    assert f.stat.st_dev == direct.stat.st_dev
+    assert f.hash == direct.hash
+    assert isinstance(files["sub"], FoundDir)
+    assert files["sub"] == FoundDir(str(tmpdir), "sub")
+    # removed entries are left out when the snapshot is copied
+    files.remove(os.path.join("sub", "a.txt"))
+    for index in range(5):
+        files["x%d" % index] = direct
+        if index:
+            del files["x%d" % (index - 1)]
+    copy = files.copy()
+    assert sorted(copy) == ["sub", "x4"]
+    assert len(copy._flags) == 2
+    assert copy["x4"] == direct
+
+
+def test_lazy_result(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, keep_snapshots=False)
+    env.writefile("racy.txt", b"contents")
+    res = env.run(
+        sys.executable,
+        "-c",
+        "import sys; open('new.txt', 'w').close(); sys.stdout.write('out\\r\\n')",
+    )
+    assert res.stdout_bytes == b"out\r\n"
+    assert res._stdout is None and res._diff is None
+    # racy files are hashed right after the run, not when compared
+    after = res.files_after
+    assert after._flags[after._index["racy.txt"]] & after._HASHED
+    assert res.stdout == "out\n"
+    assert list(res.files_created) == ["new.txt"]
+    assert not res.files_updated and not res.files_deleted
+    try:
+        res.files_before
+    except AttributeError:
+        pass
+    else:
+        assert 0
+    res.stdout = "replaced"
+    assert str(res).count("replaced") == 1
+
+
+def test_output_spill(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, output_spill_size=1000)
+    res = env.run(
+        sys.executable,
+        "-c",
+        "import sys\nfor i in range(10000): print('line %d' % i)\n"
+        "sys.stdout.write(sys.stdin.read())",
+        stdin=b"input\r\nend",
+    )
+    out = res.stdout_stream
+    assert out.spilled and not res.stderr_stream.spilled
+    assert len(out) == len(res.stdout_bytes)
+    lines = list(out.iter_lines())
+    assert len(lines) == 10002
+    assert lines[:2] == ["line 0", "line 1"]
+    assert out.tail(3) == ["line 9999", "input", "end"]
+    assert out.search(b"line 5000\n")
+    assert "line 123\n" in out and "line 10000" not in out
+    match = out.search(re.compile(rb"line (99\d\d)\s+input"))
+    assert match and match.group(1) == b"9999"
+    assert res.stdout.endswith("line 9999\ninput\nend")
+    try:
+        env.run(sys.executable, "-c", "import sys; sys.stdin.read()", stdin="text")
+    except TypeError as e:
+        assert "stdin must be bytes" in str(e)
+    else:
+        assert 0
+
+
+def test_binary_file_access(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    res = env.run(
+        sys.executable,
+        "-c",
+        "open('out.bin', 'wb').write(b'\\x89HDR\\xff\\xfe' + b'\\0' * 200000 + b'end')\n"
+        "open('empty', 'wb').close()",
+    )
+    f = res.files_created["out.bin"]
+    assert f.raw[:4] == b"\x89HDR"
+    assert len(f.raw) == f.size
+    assert b"\xff\xfe" in f and "end" in f and b"missing" not in f
+    match = f.search(re.compile(rb"\0+end$"))
+    assert match and match.start() == 6
+    assert b"".join(f.iter_chunks(4096)) == bytes(f.raw)
+    f.mustcontain(b"\x89HDR")
+    try:
+        f.mustcontain(b"missing")
+    except AssertionError:
+        pass
+    else:
+        assert 0
+    empty = res.files_created["empty"]
+    assert len(empty.raw) == 0 and b"x" not in empty
+
+
+def test_fingerprint_strategies(tmpdir):
+    from scripttest import FoundFile
+
+    env = TestFileEnvironment(
+        str(tmpdir), start_clear=False, fingerprint_paths={"*.bin": "sampled"}
+    )
+    env.writefile("big.bin", b"\0" * (2 * 1024 * 1024))
+    env.writefile("a.txt", b"text")
+    hashes = {
+        name: FoundFile(str(tmpdir), "big.bin", name).hash
+        for name in ["crc32", "blake2b", "sampled"]
+    }
+    with open(os.path.join(str(tmpdir), "big.bin"), "r+b") as f:
+        f.seek(150000)  # between two sampled blocks
+        f.write(b"\1")
+    for name, before in hashes.items():
+        after = FoundFile(str(tmpdir), "big.bin", name).hash
+        assert (after == before) == (name == "sampled"), name
+    files = env._find_files()
+    assert files["big.bin"]._algorithm == "sampled" and files["big.bin"]._hashed
+    assert files["a.txt"]._algorithm == "crc32" and not files["a.txt"]._by_content
+    res = env.run(
+        sys.executable,
+        "-c",
+        "open('a.txt', 'w').write('more text')",
+        fingerprint="blake2b",
+    )
+    f = res.files_updated["a.txt"]
+    assert f._algorithm == "blake2b" and f._hashed
+    assert res.files_after["big.bin"]._algorithm == "sampled"
+    try:
+        env.run(sys.executable, "-c", "", fingerprint="sha1")
+    except ValueError:
+        pass
+    else:
+        assert 0
+
+
+def test_arun(tmpdir):
+    import asyncio
+
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    write = (
+        "import sys, time; start = time.time(); time.sleep(0.5); "
+        "open('out.txt', 'w').write(sys.argv[1]); print(start, time.time())"
+    )
+
+    async def main():
+        res = await env.arun(
+            sys.executable,
+            "-c",
+            "import sys; sys.stdout.write(sys.stdin.read().upper())",
+            stdin=b"hello",
+        )
+        assert res.stdout == "HELLO"
+        results = await env.agather(
+            *[[sys.executable, "-c", write, str(index)] for index in range(4)],
+            {
+                "args": [sys.executable, "-c", "import sys; sys.exit(3)"],
+                "expect_error": True,
+            },
+        )
+        return res, results
+
+    res, results = asyncio.run(main())
+    assert _overlapped(results[:4])
+    for index, result in enumerate(results[:4]):
+        path = os.path.join("job-%d" % index, "out.txt")
+        assert list(result.files_created) == [path]
+        assert result.files_created[path].bytes == str(index)
+    assert results[4].returncode == 3
+
+
+def test_run_many(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    write = (
+        "import sys, time; start = time.time(); time.sleep(0.3); "
+        "open('out.txt', 'w').write(sys.argv[1]); print(start, time.time())"
+    )
+    results = env.run_many(
+        [[sys.executable, "-c", write, str(index)] for index in range(12)],
+        max_workers=12,
+    )
+    assert _overlapped(results)
+    for index, result in enumerate(results):
+        assert list(result.files_created) == [os.path.join("job-%d" % index, "out.txt")]
+    fail = "import sys; sys.stderr.write('oops'); sys.exit(int(sys.argv[1]))"
+    try:
+        env.run_many(
+            [
+                {"args": [sys.executable, "-c", fail, "0"], "quiet": True},
+                [sys.executable, "-c", write, "ok"],
+                {"args": [sys.executable, "-c", fail, "2"], "quiet": True},
+                {"args": [sys.executable, "-c", fail, "3"], "expect_error": True},
+            ],
+            sandbox="fail-%d",
+        )
+    except AssertionError as e:
+        message = str(e)
+    else:
+        assert 0
+    assert message.startswith("2 of 4 jobs failed")
+    assert "job 0 " in message and "stderr output not expected" in message
+    assert "job 2 " in message and "returned code: 2" in message
+    # Jobs finishing at once share the hash cache and the chained snapshot
+    env = TestFileEnvironment(
+        str(tmpdir.join("shared")),
+        fingerprint="content",
+        persist_hash_cache=True,
+        chain_snapshots=True,
+    )
+    env.writefiles(
+        {"job-%d/f%d.txt" % (i, j): b"%d" % j for i in range(20) for j in range(200)}
+    )
+    time.sleep(0.3)  # old enough for their hashes to be cached
+    results = env.run_many(
+        [[sys.executable, "-c", "pass"] for index in range(20)], max_workers=20
+    )
+    assert len(results) == 20
+    names = os.listdir(env.base_path)
+    assert ".scripttest-hash-cache.json" in names
+    assert not [name for name in names if "hash-cache.json." in name]
+
+
+def test_metrics(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    res = env.run(
+        sys.executable,
+        "-c",
+        "data = bytearray(64 * 1024 * 1024)\nfor i in range(10 ** 6): pass",
+    )
+    assert res.metrics["wall"] > 0
+    assert "metrics:" not in str(res)
+    assert sorted(res.timings) == [
+        "communicate",
+        "diff",
+        "snapshot_after",
+        "snapshot_before",
+        "spawn",
+    ]
+    if hasattr(os, "wait4"):
+        assert res.metrics["max_rss"] > 64 * 1024 * 1024
+        assert res.metrics["user_cpu"] > 0
+        assert "voluntary_switches" in res.metrics
+    env.report_metrics = True
+    assert "  metrics: wall " in str(res)
+    assert "  scripttest: snapshot_before " in str(res)
+
+
+def test_budgets(tmpdir):
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, max_wall=30)
+    env.run(sys.executable, "-c", "pass", max_rss=1024 * 1024 * 1024)
+    try:
+        env.run(sys.executable, "-c", "import time; time.sleep(0.3)", max_wall=0.1)
+    except AssertionError as e:
+        assert "Script exceeded its budget: wall" in str(e)
+    else:
+        assert 0
+    if not hasattr(os, "wait4"):
+        return
+    burn = "while True: pass"
+    try:
+        env.run(
+            sys.executable,
+            "-c",
+            burn,
+            max_cpu=1,
+            enforce_limits=True,
+            expect_error=True,
+            quiet=True,
+            max_wall=None,
+        )
+    except AssertionError as e:
+        # Killed by SIGXCPU, whatever its rounded CPU time says
+        assert "Script exceeded its budget: cpu" in str(e)
+    else:
+        assert 0
+    try:
+        env.run_many(
+            [
+                {"args": [sys.executable, "-c", "pass"], "max_cpu": 30},
+                {
+                    "args": [sys.executable, "-c", "x = bytearray(2 ** 27)"],
+                    "max_rss": 2**26,
+                    "quiet": True,
+                },
+            ]
+        )
+    except AssertionError as e:
+        assert str(e).startswith("1 of 2 jobs failed")
+        assert "job 1 " in str(e) and "rss 1" in str(e)
+    else:
+        assert 0
+
+
+def test_timeout(tmpdir):
+    import asyncio
+
+    env = TestFileEnvironment(str(tmpdir), start_clear=False, timeout_grace=0.5)
+    hang = """\
+import signal, subprocess, sys, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+open('partial.txt', 'w').write('x')
+print('started', flush=True)
+time.sleep(60)
+"""
+    start = time.time()
+    res = env.run(sys.executable, "-c", hang, timeout=1, expect_error=True)
+    assert time.time() - start < 10
+    assert res.timed_out and res.returncode != 0
+    assert res.stdout == "started\n"
+    assert list(res.files_created) == ["partial.txt"]
+    assert "timed out" in str(res)
+    try:
+        env.run(sys.executable, "-c", hang, timeout=1, quiet=True)
+    except AssertionError as e:
+        assert "timed out" in str(e)
+    else:
+        assert 0
+    res = asyncio.run(
+        env.arun(sys.executable, "-c", hang, timeout=1, expect_error=True)
+    )
+    assert res.timed_out and res.stdout == "started\n"
+    assert not env.run(sys.executable, "-c", "pass", timeout=30).timed_out
+
+
+def test_forkserver(tmpdir):
+    env = TestFileEnvironment(
+        str(tmpdir),
+        start_clear=False,
+        forkserver=True,
+        forkserver_preload=["json", "json.tool"],
+    )
+    code = """\
+import os, sys
+print(sys.argv, os.getcwd(), os.environ.get('GREETING'), input())
+open('out.txt', 'w').write('x')
+sys.exit('bye')
+"""
+    env.environ["GREETING"] = "hello"
+    res = env.run(sys.executable, "-c", code, "a", stdin=b"in\n", expect_error=True)
+    assert res.returncode == 1
+    assert res.stdout == "['-c', 'a'] %s hello in\n" % tmpdir
+    assert res.stderr == "bye\n"
+    assert list(res.files_created) == ["out.txt"]
+    res = env.run(sys.executable, script, "test-file.txt")
+    assert res.stdout == "Writing test-file.txt\n"
+    assert "test-file.txt" in res.files_created
+    res = env.run(sys.executable, "-c", "1/0", expect_error=True)
+    assert res.returncode == 1
+    assert res.stderr.endswith("ZeroDivisionError: division by zero\n")
+    # Preloaded, so runpy would warn that it was imported already
+    res = env.run(sys.executable, "-m", "json.tool", stdin=b'{"a": 1}')
+    assert res.stdout == '{\n    "a": 1\n}\n'
+    # Runs the server can't reproduce start a new process
+    assert env.run(sys.executable, "-E", "-c", "print(1)").stdout == "1\n"
+    results = env.run_many([[sys.executable, "-c", "print(%d)" % i] for i in range(4)])
+    assert [r.stdout for r in results] == ["%d\n" % i for i in range(4)]
+    # Environments with the same preload share one server
+    ppid = "import os; print(os.getppid())"
+    other = TestFileEnvironment(
+        str(tmpdir.join("other")),
+        forkserver=True,
+        forkserver_preload=["json", "json.tool"],
+    )
+    server = env.run(sys.executable, "-c", ppid).stdout
+    assert other.run(sys.executable, "-c", ppid).stdout == server
+
+
+def test_run_python(tmpdir):
+    import tempfile
+    import scripttest
+
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    env.environ["GREETING"] = "hello"
+    res = env.run_python(
+        "json.tool", "--sort-keys", "-", "out.json", stdin=b'{"b": 1, "a": 2}'
+    )
+    assert res.returncode == 0
+    assert list(res.files_created) == ["out.json"]
+    assert res.files_created["out.json"].bytes == '{\n    "a": 2,\n    "b": 1\n}\n'
+    # The installed console scripts are only looked up once
+    hits = scripttest._console_scripts.cache_info().hits
+    res = env.run_python("json.tool:main", "missing.json", expect_error=True)
+    assert res.returncode == 2
+    assert "missing.json" in res.stderr
+    res = env.run_python("os:getcwd", expect_error=True)
+    assert res.returncode == 1 and res.stderr == "%s\n" % tmpdir
+    env.run_python("json.tool", stdin=b"{}")
+    assert scripttest._console_scripts.cache_info().hits > hits
+    assert "GREETING" not in os.environ
+    with tempfile.TemporaryDirectory() as parent_temp:
+        res = env.run_python("json.tool", "-", "iso.json", stdin=b"[]", isolate=True)
+        # The child doesn't run the exit handlers of the test process
+        assert os.path.isdir(parent_temp)
+    assert list(res.files_created) == ["iso.json"]
+    res = env.run_python("json.tool", stdin=b"{", isolate=True, expect_error=True)
+    assert res.returncode == 1 and "Expecting property name" in res.stderr
+
+
+def test_environment_pool(tmpdir):
+    from scripttest import EnvironmentPool
+
+    def setup(env):
+        env.writefile("keep.txt", b"keep")
+        env.writefile("data/big.bin", b"x" * 100000)
+        env.writefile("data/sub/small.txt", b"small")
+
+    pool = EnvironmentPool(str(tmpdir.join("pool")), setup=setup, chain_snapshots=True)
+    with pool.sandbox() as env:
+        first = env.base_path
+        env.run(
+            sys.executable,
+            "-c",
+            "import os, shutil; open('keep.txt', 'w').write('changed'); "
+            "shutil.rmtree('data'); os.mkdir('new'); open('new/f', 'w').write('f')",
+        )
+    with pool.sandbox() as env:
+        assert env.base_path == first
+        res = env.run(sys.executable, "-c", "pass")
+        assert not (res.files_created or res.files_deleted or res.files_updated)
+        assert sorted(os.listdir(env.base_path)) == [
+            ".scripttest-test-dir.txt",
+            "data",
+            "keep.txt",
+        ]
+        assert open(os.path.join(env.base_path, "keep.txt")).read() == "keep"
+        with open(os.path.join(env.base_path, "data", "big.bin"), "rb") as f:
+            assert f.read() == b"x" * 100000
+        env.writefile("keep.txt", b"again")
+        with pool.sandbox() as other:
+            assert other.base_path != first
+    with pool.sandbox() as env:
+        assert open(os.path.join(env.base_path, "keep.txt")).read() == "keep"
+        assert os.path.exists(os.path.join(env.base_path, "data/sub/small.txt"))
+        # Behind the back of the chained snapshot
+        open(os.path.join(env.base_path, "stray.txt"), "w").close()
+    with pool.sandbox() as env:
+        assert "stray.txt" not in os.listdir(env.base_path)
+        os.makedirs(os.path.join(env.base_path, ".cache", "sub"))
+        open(os.path.join(env.base_path, "data", ".hidden"), "w").close()
+    with pool.sandbox() as env:
+        assert sorted(os.listdir(env.base_path)) == [
+            ".scripttest-test-dir.txt",
+            "data",
+            "keep.txt",
+        ]
+        assert sorted(os.listdir(os.path.join(env.base_path, "data"))) == [
+            "big.bin",
+            "sub",
+        ]
+        res = env.run(sys.executable, "-c", "open('stray.txt', 'w').close()")
+        assert list(res.files_created) == ["stray.txt"]
+
+
+def test_environment_pool_symlinks(tmpdir):
+    from scripttest import EnvironmentPool
+
+    if not hasattr(os, "symlink"):
+        return
+
+    def setup(env):
+        env.writefile("target.txt", b"target")
+        os.symlink("target.txt", os.path.join(env.base_path, "link"))
+        os.symlink("missing", os.path.join(env.base_path, "dangling"))
+
+    pool = EnvironmentPool(str(tmpdir.join("pool")), setup=setup)
+    with pool.sandbox() as env:
+        first = env.base_path
+        env.run(
+            sys.executable,
+            "-c",
+            "import os; os.remove('link'); os.remove('dangling'); "
+            "open('dangling', 'w').write('file')",
+        )
+    with pool.sandbox() as env:
+        assert env.base_path == first
+        for name, target in [("link", "target.txt"), ("dangling", "missing")]:
+            full = os.path.join(env.base_path, name)
+            assert os.path.islink(full)
+            assert os.readlink(full) == target
+        assert open(os.path.join(env.base_path, "link")).read() == "target"
+        res = env.run(sys.executable, "-c", "pass")
+        assert not (res.files_created or res.files_deleted or res.files_updated)
+
+
+def test_copytree_from_template(tmpdir):
+    template = tmpdir.join("template")
+    template.join("pkg", "sub").ensure(dir=True)
+    template.join("pkg", "big.bin").write_binary(os.urandom(3 * 1024 * 1024))
+    template.join("pkg", "sub", "run.sh").write("#!/bin/sh\n")
+    template.join("pkg", "sub", "run.sh").chmod(0o755)
+    env = TestFileEnvironment(str(tmpdir.join("out")), template_path=str(template))
+    found = env.writefile("copied.bin", frompath="pkg/big.bin")
+    with open(found.full, "rb") as f:
+        assert f.read() == template.join("pkg", "big.bin").read_binary()
+    for mode in ("auto", "copy", "hardlink"):
+        env.copytree_from_template("pkg", mode, mode=mode)
+        copied = os.path.join(env.base_path, mode)
+        with open(os.path.join(copied, "big.bin"), "rb") as f:
+            assert f.read() == template.join("pkg", "big.bin").read_binary()
+        run_sh = os.path.join(copied, "sub", "run.sh")
+        assert os.stat(run_sh).st_mode & 0o777 == 0o755
+        same = os.path.samefile(run_sh, str(template.join("pkg", "sub", "run.sh")))
+        assert same == (mode == "hardlink")
+    # Copying over hard links to the template leaves the template alone
+    big = template.join("pkg", "big.bin").read_binary()
+    for mode in ("hardlink", "auto"):
+        env.copytree_from_template("pkg", "hardlink", mode=mode)
+    assert template.join("pkg", "big.bin").read_binary() == big
+    assert template.join("pkg", "sub", "run.sh").read() == "#!/bin/sh\n"
+    run_sh = os.path.join(env.base_path, "hardlink", "sub", "run.sh")
+    assert not os.path.samefile(run_sh, str(template.join("pkg", "sub", "run.sh")))
+    res = env.run(sys.executable, "-c", "pass")
+    assert not res.files_created
+    try:
+        env.copytree_from_template("pkg", "x", mode="reflink")
+    except ValueError as e:
+        assert "mode must be one of" in str(e)
+    else:
+        assert 0
+
+
+def test_writefiles(tmpdir):
+    import io
+    import stat
+    import tarfile
+    import zipfile
+
+    env = TestFileEnvironment(str(tmpdir), start_clear=False)
+    files = {"pkg/mod%d.py" % i: "x = %d\n" % i for i in range(50)}
+    files["pkg/sub/data.bin"] = b"\0\1"
+    found = env.writefiles(files, workers=4)
+    assert len(found) == 51
+    assert found["pkg/mod7.py"].bytes == "x = 7\n"
+    assert found["pkg/sub/data.bin"].size == 2
+    res = env.run(sys.executable, "-c", "pass")
+    assert not res.files_created
+    found = env.writefiles([("top.txt", b"top")])
+    assert list(found) == ["top.txt"]
+
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tf:
+        info = tarfile.TarInfo("./tool/run.sh")
+        info.size = 5
+        info.mode = 0o755
+        tf.addfile(info, io.BytesIO(b"hello"))
+        info = tarfile.TarInfo("tool/empty")
+        info.type = tarfile.DIRTYPE
+        tf.addfile(info)
+    found = env.writearchive(data.getvalue(), "fromtar")
+    assert list(found) == [os.path.join("fromtar", "tool", "run.sh")]
+    assert (
+        os.stat(found[os.path.join("fromtar", "tool", "run.sh")].full).st_mode & 0o777
+        == 0o755
+    )
+    assert os.path.isdir(os.path.join(env.base_path, "fromtar", "tool", "empty"))
+
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zf:
+        zf.writestr("a/b.txt", "zipped")
+        zf.writestr("../evil.txt", "no")
+    data.seek(0)
+    try:
+        env.writearchive(data, "fromzip")
+    except ValueError as e:
+        assert "outside" in str(e)
+    else:
+        assert 0
+    assert not os.path.exists(os.path.join(env.base_path, "fromzip"))
+
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zf:
+        info = zipfile.ZipInfo("link")
+        info.external_attr = (stat.S_IFLNK | 0o777) << 16
+        zf.writestr(info, "/etc/passwd")
+    try:
+        env.writearchive(data.getvalue(), "fromzip")
+    except ValueError as e:
+        assert "not a file or directory" in str(e)
+    else:
+        assert 0
+    assert not os.path.exists(os.path.join(env.base_path, "fromzip"))
+
+
+def test_background_clear(tmpdir):
+    import scripttest
+
+    base = tmpdir.join("env")
+    env = TestFileEnvironment(str(base), background_clear=True)
+    env.writefiles({"dir%d/file.txt" % i: b"x" for i in range(100)})
+    stale = tmpdir.join("env.scripttest-trash-1-1").ensure(dir=True)
+    env.clear()
+    assert os.listdir(env.base_path) == [".scripttest-test-dir.txt"]
+    scripttest._reaper.finish()
+    assert sorted(os.listdir(str(tmpdir))) == ["env"]
+    assert not stale.exists()
+    base.join(".scripttest-test-dir.txt").remove()
+    try:
+        env.clear()
+    except AssertionError as e:
+        assert "not created by ScriptTest" in str(e)
+    else:
+        assert 0
+    # A relative base_path is still found once the working directory changed
+    with tmpdir.join("cwd").ensure(dir=True).as_cwd():
+        env = TestFileEnvironment("rel", background_clear=True)
+        env.writefiles({"dir%d/file.txt" % i: b"x" for i in range(100)})
+        env.clear()
+    scripttest._reaper.finish()
+    assert sorted(os.listdir(str(tmpdir.join("cwd")))) == ["rel"]